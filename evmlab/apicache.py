@@ -0,0 +1,212 @@
+"""
+Persistent cache for the chain data fetched by MultiApi (accounts, storage slots, transactions)
+"""
+import sqlite3, pickle, threading, logging, collections
+
+logger = logging.getLogger(__name__)
+
+
+class StateCache(object):
+    """ SQLite-backed cache, holding one long-lived connection.
+
+    Entries are indexed by (kind, address, block, slot), e.g.
+    ('storage', '0xabc..', 4500000, '0x0'). Use block -1 and slot '' for entries which
+    don't have those. Values are pickled.
+
+    The cache is bounded to `maxentries`; when full, the least recently used
+    entries are evicted. Hits only record their use once the entry is in the older
+    half of the cache, so that most lookups don't write.
+    """
+
+    def __init__(self, path = ".api_cache.sqlite", maxentries = 2000000):
+        self.path = path
+        self.maxentries = maxentries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._count = 0
+        # recency counter for the LRU eviction
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._db is not None:
+            return self._db
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                        kind TEXT, address TEXT, block INTEGER, slot TEXT,
+                        value BLOB, used INTEGER,
+                        PRIMARY KEY (kind, address, block, slot)) WITHOUT ROWID""")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache(used)")
+        db.commit()
+        (self._count, clock) = db.execute("SELECT COUNT(*), MAX(used) FROM cache").fetchone()
+        self._clock = clock or 0
+        self._db = db
+        return db
+
+    def _tick(self):
+        self._clock = self._clock + 1
+        return self._clock
+
+    def get(self, key):
+        """ Returns the cached value for the key tuple, or None """
+        return self.getMany([key]).get(key)
+
+    def getMany(self, keys):
+        """ Looks up several keys at once, returns a dict of key -> value for the hits """
+        keys = list(keys)
+        found = {}
+        stale = []
+        with self._lock:
+            db = self._open()
+            # Stay below the sqlite limit on the number of bound parameters
+            for i in range(0, len(keys), 200):
+                chunk = keys[i:i + 200]
+                where = " OR ".join(["(kind=? AND address=? AND block=? AND slot=?)"] * len(chunk))
+                params = [p for key in chunk for p in key]
+                for row in db.execute("SELECT kind, address, block, slot, value, used FROM cache WHERE %s" % where, params):
+                    key = tuple(row[:4])
+                    found[key] = pickle.loads(row[4])
+                    # Fewer than clock - used entries are more recent than this one, so it can't
+                    # be evicted until that reaches 90% of the capacity; only entries in the older
+                    # half are marked as used, to avoid a write on most hits
+                    if self._clock - row[5] > self.maxentries // 2:
+                        stale.append(key)
+
+            if stale:
+                db.executemany("UPDATE cache SET used=? WHERE kind=? AND address=? AND block=? AND slot=?",
+                               [(self._tick(),) + key for key in stale])
+                db.commit()
+
+            self.hits = self.hits + len(found)
+            self.misses = self.misses + len(keys) - len(found)
+        return found
+
+    def put(self, key, value):
+        self.putMany({key: value})
+
+    def putMany(self, items):
+        """ Stores a dict of key -> value at once """
+        if not items:
+            return
+        with self._lock:
+            db = self._open()
+            rows = [key + (pickle.dumps(value), self._tick()) for (key, value) in items.items()]
+            # an existing entry is replaced, which counts as a delete and an insert
+            existing = self._existing(db, list(items.keys()))
+            db.executemany("INSERT OR REPLACE INTO cache (kind, address, block, slot, value, used) VALUES (?,?,?,?,?,?)", rows)
+            self._count = self._count + len(rows) - existing
+            if self._count > self.maxentries:
+                self._evict(db)
+            db.commit()
+
+    def _existing(self, db, keys):
+        n = 0
+        for i in range(0, len(keys), 200):
+            chunk = keys[i:i + 200]
+            where = " OR ".join(["(kind=? AND address=? AND block=? AND slot=?)"] * len(chunk))
+            n = n + db.execute("SELECT COUNT(*) FROM cache WHERE %s" % where, [p for key in chunk for p in key]).fetchone()[0]
+        return n
+
+    def _evict(self, db):
+        # Evict down to 90% of the capacity, so that eviction doesn't happen on every put
+        n = self._count - int(self.maxentries * 0.9)
+        db.execute("DELETE FROM cache WHERE used IN (SELECT used FROM cache ORDER BY used LIMIT ?)", (n,))
+        self._count = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        logger.info("Evicted %d entries from %s" % (n, self.path))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': self._count}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class MemoryCache(object):
+    """ Bounded in-process LRU cache, with the same interface as StateCache.
+
+    It is bounded both in number of entries and (pickled) size in bytes.
+    Misses are looked up in the `backend` cache, if any, and writes go through to it.
+
+    Values are kept pickled, so that callers get their own copy, which
+    they can modify without changing the cached value.
+    """
+
+    def __init__(self, backend = None, maxentries = 100000, maxbytes = 64 * 1024 * 1024):
+        self.backend = backend
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # key -> pickled value, in order of use
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.getMany([key]).get(key)
+
+    def getMany(self, keys):
+        keys = list(keys)
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = pickle.loads(self._entries[key])
+                else:
+                    missing.append(key)
+            self.hits = self.hits + len(found)
+            self.misses = self.misses + len(missing)
+
+        if missing and self.backend is not None:
+            loaded = self.backend.getMany(missing)
+            with self._lock:
+                for (key, value) in loaded.items():
+                    self._insert(key, value)
+            found.update(loaded)
+        return found
+
+    def put(self, key, value):
+        self.putMany({key: value})
+
+    def putMany(self, items):
+        with self._lock:
+            for (key, value) in items.items():
+                self._insert(key, value)
+        if self.backend is not None:
+            self.backend.putMany(items)
+
+    def _insert(self, key, value):
+        if key in self._entries:
+            self.size = self.size - len(self._entries.pop(key))
+        data = pickle.dumps(value)
+        if len(data) > self.maxbytes:
+            return
+        self._entries[key] = data
+        self.size = self.size + len(data)
+        while len(self._entries) > self.maxentries or self.size > self.maxbytes:
+            (_, evicted) = self._entries.popitem(last=False)
+            self.size = self.size - len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.size}
+        if self.backend is not None:
+            stats['backend'] = self.backend.stats()
+        return stats
+
+    def close(self):
+        self.clear()
+        if self.backend is not None:
+            self.backend.close()
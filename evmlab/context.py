@@ -1,5 +1,6 @@
 from .contract import Contract
 from . import mk_contract_address, encode_hex
+from .traceindex import TraceIndex
 
 def buildContexts(ops, api, contracts, txhash):
     contract_stack = []
@@ -64,62 +65,6 @@ def getAddresses(ops, original_contract):
     """ determine the address of the sourceCode for each operation
      Returns an array of addresses, 1 for each op in ops
      """
-    addresses = []
-
-    cur_depth = None
-    prev_depth = None
-    prev_op = None
-    cur_address = original_contract
-    place_holders = []  # stores the index of where CREATE op addr should go in the addr_stack
-    depth_to_addr = {}  # mapping to track depth to an addr so we can easily push the current addr on the stack when we return from a call
-
-    step = 0
-    for o in ops:
-        if not 'depth' in o.keys():
-            # We're done here
-            break
-
-        # Address tracking
-        cur_depth = o['depth']
-
-        # depth may not always start at 1. ganache-cli starts at 0
-        # this will set the prev_depth from the first op
-        if not prev_op:
-            prev_depth = cur_depth
-            depth_to_addr[cur_depth] = cur_address
-
-        if cur_depth > prev_depth:
-            # Made it into a call-variant
-            # All call-lookalikes are 'gas,address,value' on stack,
-            # so address is second item of prev line
-            #
-            # There's one exception, though; CREATE
-            # With a CREATE, we don't know the address until after the RETURN
-            # so we push a placeholder and update on the Return
-            if prev_op['op'] == 0xf0:
-                cur_address = None
-                place_holders.append([len(addresses)])
-            else:
-                cur_address = prev_op['stack'][-2]
-
-            depth_to_addr[cur_depth] = cur_address
-
-        if cur_depth < prev_depth:
-            # RETURN op. we now know the prev_depth address, so add to context
-            if cur_address is None and prev_op['op'] == 0xf3:
-                prev_address = o['stack'][-1]
-                for i in place_holders.pop():
-                    addresses[i] = prev_address
-            # Returned from a call
-            cur_address = depth_to_addr[cur_depth]
-
-        if not cur_address:
-            place_holders[-1].append(len(addresses))
-
-        addresses.append(cur_address)
-        prev_op = o
-        prev_depth = cur_depth
-
     # handle debug_traceTransaction output
     def fixAddr(a):
         if a and len(a) > 40:
@@ -128,9 +73,7 @@ def getAddresses(ops, original_contract):
             else:
                 return "0x%s" % a[24:]
 
-    addresses = [fixAddr(a) for a in addresses]
-
-    return addresses
+    return [fixAddr(a) for a in TraceIndex(ops, original_contract).addresses]
 
 
 def findContractForBytecode(contracts, bytecode):
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
-import re
+from array import array
 
 from evmlab.opcodes import parseCode
+from evmlab.source_index import SourceIndex
 
 """
 Solidity source code mappings, as 
@@ -35,6 +36,17 @@ def parseSourceMap(maptext):
     return mapping
 
 
+def instructionIndex(ins):
+    """ Returns an array with the index of the instruction starting at each pc,
+    or -1 for pushdata """
+    if not ins:
+        return array('i')
+    index = array('i', [-1]) * (next(reversed(ins)) + 1)
+    for (i, pc) in enumerate(ins):
+        index[pc] = i
+    return index
+
+
 class Contract():
     _create = False
 
@@ -42,6 +54,9 @@ class Contract():
     ins = None
     binRuntime = None
     insRuntime = None
+    # pc -> index into ins/insRuntime (and the source mappings)
+    insIndex = None
+    insRuntimeIndex = None
     lastSource = None
     name = ""
 
@@ -105,45 +120,14 @@ class Contract():
                     l = int(l)
                     break
 
-        # see if text contains multiple contracts
-        contract_start_indices = [m.start(0)
-                                  for m in re.finditer('^ *contract ', c)]
-
-        # for multi contract files, get the start of the contract for the current instruction
-        if len(contract_start_indices) > 1:
-            contract_start = 0
-            contract_end = -1
-
-            for i in contract_start_indices:
-                if i == s:
-                    contract_start = s
-                    break
-                elif i > s:
-                    # get the previous index
-                    ci = contract_start_indices.index(i) - 1
-                    if ci >= 0:
-                        contract_start = contract_start_indices[ci]
-                    break
-                elif s > i and i == contract_start_indices[-1]:
-                    contract_start = contract_start_indices[-1]
-
-            pos = contract_start + c[contract_start:].find('{')
-            openBr = 0
-            while pos < len(c):
-                if c[pos] == '{':
-                    openBr += 1
-                elif c[pos] == '}':
-                    openBr -= 1
-
-                if openBr == 0:
-                    contract_end = pos + 1
-                    break
-
-                pos += 1
+        # for multi contract files, get the contract for the current instruction
+        contract_range = SourceIndex.of(c).contractRange(s)
+        if contract_range is not None:
+            (contract_start, contract_end, text) = contract_range
 
             # return only the contract we're interested in
             # we need to update the bytes start & end pos to reflect the truncated text we are returning
-            res = (c[contract_start:contract_end], [s - contract_start, l])
+            res = (text, [s - contract_start, l])
             self._sourceCache[h] = res
 
             self.lastSource = h
@@ -171,11 +155,10 @@ class Contract():
         return mapping[i]
 
     def _getMappingIndex(self, pc):
-        ins = self.ins if self.create else self.insRuntime
-        pcs = list(ins.keys())
+        index = self.insIndex if self.create else self.insRuntimeIndex
 
-        if pc in pcs:
-            return pcs.index(pc)
+        if index is not None and 0 <= pc < len(index) and index[pc] >= 0:
+            return index[pc]
 
         raise KeyError
 
@@ -194,11 +177,13 @@ class Contract():
         if bytecode:
             self.binRuntime = bytecode
             self.insRuntime = parseCode(bytecode)
+            self.insRuntimeIndex = instructionIndex(self.insRuntime)
 
         bytecode = load('bin')
         if bytecode:
             self.bin = bytecode
             self.ins = parseCode(bytecode)
+            self.insIndex = instructionIndex(self.ins)
 
         self.mappingRuntime = parseSourceMap(load('srcmap-runtime'))
         self.mapping = parseSourceMap(load('srcmap'))
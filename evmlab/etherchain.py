@@ -2,6 +2,11 @@
 import os
 import requests
 import json
+import mmap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 here = os.path.dirname(os.path.abspath(__file__))
 
@@ -26,12 +31,178 @@ def loadjson(fname):
         return None
 
 
+class AppendStore(object):
+    """ Append-only on-disk store of json objects, with an index for lookups by key.
+
+    The objects are appended as json lines to `<name>.jsonl` in the datastore, and for each
+    key the (offset, length) of the object is appended to `<name>.idx`. An object can
+    have several keys (e.g. block hash and number). Only the index is loaded when opening,
+    objects are read on demand from a memory-map of the data file.
+    """
+
+    def __init__(self, name, directory = None):
+        directory = directory or os.path.join(here, "datastore")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.datafile = os.path.join(directory, "%s.jsonl" % name)
+        self.indexfile = os.path.join(directory, "%s.idx" % name)
+        # key -> (offset, length)
+        self.index = {}
+        # offsets of all objects, in order
+        self.offsets = []
+        self._map = None
+        self._lock = threading.Lock()
+        self._data = open(self.datafile, "ab+")
+        self._loadIndex()
+
+    def _loadIndex(self):
+        size = os.path.getsize(self.datafile)
+        seen = set()
+        if os.path.exists(self.indexfile):
+            with open(self.indexfile, "r") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 3:
+                        continue
+                    (key, offset, length) = (parts[0], int(parts[1]), int(parts[2]))
+                    # Ignore entries for data that never made it to disk
+                    if offset + length > size:
+                        continue
+                    self.index[key] = (offset, length)
+                    if offset not in seen:
+                        seen.add(offset)
+                        self.offsets.append(offset)
+        self.offsets.sort()
+
+    def _read(self, offset, length):
+        if self._map is None or offset + length > len(self._map):
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        return json.loads(self._map[offset:offset + length].decode())
+
+    def __contains__(self, key):
+        return str(key) in self.index
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, key, default = None):
+        key = str(key)
+        with self._lock:
+            if key not in self.index:
+                return default
+            return self._read(*self.index[key])
+
+    def put(self, keys, obj):
+        """ Appends the object, to be found under each of the keys """
+        self.putMany([(keys, obj)])
+
+    def putMany(self, items):
+        """ Appends several (keys, obj), with one write to each file """
+        if not items:
+            return
+        with self._lock:
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            data = []
+            entries = []
+            for (keys, obj) in items:
+                line = (json.dumps(obj) + "\n").encode()
+                data.append(line)
+                for key in keys:
+                    entries.append((str(key), offset, len(line) - 1))
+                self.offsets.append(offset)
+                offset = offset + len(line)
+            self._data.write(b"".join(data))
+            self._data.flush()
+            with open(self.indexfile, "a") as f:
+                f.write("".join("%s\t%d\t%d\n" % e for e in entries))
+            for (key, offset, length) in entries:
+                self.index[key] = (offset, length)
+
+    def values(self):
+        """ Returns all objects, in the order they were appended """
+        with self._lock:
+            offsets = list(self.offsets)
+            lengths = {o: l for (o, l) in self.index.values()}
+        for offset in offsets:
+            with self._lock:
+                obj = self._read(offset, lengths[offset])
+            yield obj
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._data.close()
+
+
+class RateLimiter(object):
+    """ Spaces out calls to `wait`, so that at most `rate` calls per second pass """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class EtherChainAPI():
 
-    def __init__(self, offline = False):
+    PAGESIZE = 50
+
+    def __init__(self, offline = False, baseurl = "https://etherchain.org", workers = 8, rate = 10, datastore = None):
+        """
+        @param workers - max number of requests in flight
+        @param rate - max number of requests per second
+        @param datastore - directory for the cached data
+        """
         self.offline = offline
+        self.baseurl = baseurl.rstrip("/")
+        self.workers = workers
+        self.datastore = datastore
         self.cachedBlocks = None
-        self.flushcounter = 0
+        self.limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        self.session.mount(self.baseurl, HTTPAdapter(pool_maxsize=workers))
+
+    def _get(self, path):
+        self.limiter.wait()
+        url = "%s%s" % (self.baseurl, path)
+        log(url)
+        return self.session.get(url)
+
+    def _openStore(self, name, legacyItems):
+        """ Opens the AppendStore `name`. If it's empty, the data cached by earlier versions
+        in `<name>.json` is imported once, using `legacyItems(data)` to get its (keys, obj) """
+        store = AppendStore(name, self.datastore)
+        legacy = os.path.join(store.directory, "%s.json" % name)
+        if len(store) == 0 and os.path.exists(legacy):
+            try:
+                with open(legacy, 'r') as infile:
+                    items = legacyItems(json.loads(infile.read()))
+            except Exception as e:
+                log("Could not import %s (%s), it is no longer used" % (legacy, e))
+            else:
+                store.putMany(items)
+                log("Imported %d entries from %s into %s, it is no longer used" % (len(items), legacy, store.datafile))
+        return store
+
+    def _map(self, fn, items):
+        """ Calls fn for each item, with at most `workers` requests in flight """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fn, items))
 
     def getBlockInfo(self, blockNumberOrHash):
         """
@@ -58,24 +229,21 @@ class EtherChainAPI():
         """
         # Load cached data
         if self.cachedBlocks == None:
-            self.cachedBlocks = loadjson(".blocks.json") or {}
+            def legacyBlocks(blocks):
+                # each block was stored under both its hash and number
+                unique = {block['hash']: block for block in blocks.values()}
+                return [([block['hash'], block['number']], block) for block in unique.values()]
+            self.cachedBlocks = self._openStore(".blocks", legacyBlocks)
 
-        if(self.cachedBlocks.has_key(blockNumberOrHash)):
-            return self.cachedBlocks[blockNumberOrHash]
+        cached = self.cachedBlocks.get(blockNumberOrHash)
+        if cached is not None:
+            return cached
 
 
-        url = "https://etherchain.org/api/block/%s"  % str(blockNumberOrHash)
-        log(url)
-        data = requests.get(url).json()['data'][0]
+        data = self._get("/api/block/%s" % str(blockNumberOrHash)).json()['data'][0]
 
         #save
-        self.cachedBlocks[data['hash']] = data
-        self.cachedBlocks[data['number']] = data
-
-        self.flushcounter = self.flushcounter+1
-        if self.flushcounter > 50:#Always on now
-            savejson('.blocks.json', self.cachedBlocks)
-            self.flushcounter =0 
+        self.cachedBlocks.put([data['hash'], data['number']], data)
 
         return data
     def getBlockTime(self, blockNumberOrHash):
@@ -83,7 +251,7 @@ class EtherChainAPI():
 
 
     def getTransaction(self, txhash):
-        return requests.get("https://etherchain.org/api/tx/%s" % txhash).json()['data'][0]
+        return self._get("/api/tx/%s" % txhash).json()['data'][0]
 
     def getAllTransactions(self, address):
         """ Returns an iterator of all transactions to/from the specified address
@@ -91,49 +259,55 @@ class EtherChainAPI():
             transactions
         """
         # Load cached data
-        cachedTransactions = loadjson(".%s-transactions.json" % address) or {'byhash':{}}
-
-        tx_byhash = cachedTransactions['byhash']
+        store = self._openStore(".%s-transactions" % address,
+                                lambda cached: [([tx['hash']], tx) for tx in cached['byhash'].values()])
 
         stats = {"added" : 0}
-        
-        def insert(tx):
-            if not tx_byhash.has_key(tx['hash']):
-                tx_byhash[tx['hash']] = tx
-                stats['added'] = stats['added']+1
-                return True
-            return False
-
-        #Fetch new data
+
+        def fetchPage(offset):
+            resp = self._get("/api/account/%s/tx_asc/%d" % (address, offset))
+            if resp.status_code != 200:
+                raise Exception("Failed to get %s history" % address)
+            return resp.json()['data']
+
+        #Fetch new data, several pages at a time. The pages are appended to the store
+        #in order, so an interrupted fetch continues after the last stored page
         abort = self.offline
-        while not abort:
-            offset = len(tx_byhash)
-
-            url = "https://etherchain.org/api/account/%s/tx_asc/%d" % (address, offset)
-            log(url)
-            resp = requests.get(url)
-            if resp.status_code == 200 :
-                jsondata = resp.json()['data']
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            nextOffset = len(store)
+            window = []
+            while not abort:
+                while len(window) < self.workers:
+                    window.append(executor.submit(fetchPage, nextOffset))
+                    nextOffset = nextOffset + self.PAGESIZE
+
+                jsondata = window.pop(0).result()
+                new = []
                 for tx in jsondata:
-                    if not insert(tx): 
+                    if tx['hash'] in store:
                         log("Error, we got a tx we already have. Probably missing earlier transactions for %s" % address)
                         abort = True
+                    else:
+                        new.append(([tx['hash']], tx))
+                store.putMany(new)
+                stats['added'] = stats['added'] + len(new)
 
-                if len(jsondata) < 50:
+                if len(jsondata) < self.PAGESIZE:
                     abort = True
 
-            else:
-                raise Exception("Failed to get %s history" % instr)
-
+            # The pages after the end aren't needed
+            for f in window:
+                f.cancel()
 
-        #Save cache
         if stats['added'] > 0:
-            savejson(".%s-transactions.json" % address, cachedTransactions)
             print("Added %d transactions for %s" % (stats['added'], address))
 
         # Return txs starting at lowest nonce
-        for h,tx in tx_byhash.items():
-            yield tx
+        try:
+            for tx in store.values():
+                yield tx
+        finally:
+            store.close()
 
 
     def outgoingTransactions(self, address):
@@ -179,18 +353,20 @@ class EtherChainAPI():
         return (senders, totalCost, allTxs)
 
     def getAccount(self, address):
-        return requests.get("https://etherchain.org/api/account/%s" % address).json()['data'][0]
+        return self._get("/api/account/%s" % address).json()['data'][0]
 
 
     def getBalance(self, address):
-        return requests.get("https://etherchain.org/api/account/%s" % address).json()['data'][0]['balance']
+        return self.getAccount(address)['balance']
 
     def getCode(self, address):
-        return requests.get("https://etherchain.org/api/account/%s" % address).json()['data'][0]['code']
+        return self.getAccount(address)['code']
 
 
     def getBalances(self,addresses):
-        return [(address,self.getBalance(address)) for address in addresses]
+        """ Fetches the balances concurrently, returns a list of (address, balance) """
+        addresses = list(addresses)
+        return list(zip(addresses, self._map(self.getBalance, addresses)))
 
 
     def findNewContracts(self, address):
@@ -208,7 +384,7 @@ class EtherChainAPI():
         knownContracts = loadjson(".%s-contracts.json" % address) or {}
 
         diff = []
-        for k,v in foundContracts.iteritems():
+        for k,v in foundContracts.items():
             if not k in knownContracts.keys():
                 diff.append(v)
                 knownContracts[k] = v
@@ -1,5 +1,6 @@
 import os
 import json
+import string
 from .opcodes import opcodes
 from . import compiler
 
@@ -33,30 +34,107 @@ OPCODE_FORMATS = {
     "CREATE":       "CREATE(val={0}, offset={1}, size={2})"
 }
 
+def formatParts(fmt):
+    """ Splits a format string into a list of (literal text, argument index or None) """
+    return [(literal, None if field is None else int(field))
+            for (literal, field, spec, conversion) in string.Formatter().parse(fmt)]
+
+OPCODE_FORMAT_PARTS = {opname: formatParts(fmt) for (opname, fmt) in OPCODE_FORMATS.items()}
+
+# number of items pushed by each opcode, used to read its results off the stack of the next step
+NPUSHES = {0: 0, 1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1, 8: 1, 9: 1, 10: 1, 11: 1, 16: 1, 17: 1, 18: 1, 19: 1, 20: 1, 21: 1, 22: 1, 23: 1, 24: 1, 25: 1, 26: 1, 32: 1, 48: 1, 49: 1, 50: 1, 51: 1, 52: 1, 53: 1, 54: 1, 55: 0, 56: 1, 57: 0, 58: 1, 59: 1, 60: 0, 61: 1, 62: 0, 64: 1, 65: 1, 66: 1, 67: 1, 68: 1, 69: 1, 80: 0, 81: 1, 82: 0, 83: 0, 84: 1, 85: 0, 86: 0, 87: 0, 88: 1, 89: 1, 90: 1, 91: 0, 96: 1, 97: 1, 98: 1, 99: 1, 100: 1, 101: 1, 102: 1, 103: 1, 104: 1, 105: 1, 106: 1, 107: 1, 108: 1, 109: 1, 110: 1, 111: 1, 112: 1, 113: 1, 114: 1, 115: 1, 116: 1, 117: 1, 118: 1, 119: 1, 120: 1, 121: 1, 122: 1, 123: 1, 124: 1, 125: 1, 126: 1, 127: 1, 128: 2, 129: 3, 130: 4, 131: 5, 132: 6, 133: 7, 134: 8, 135: 9, 136: 10, 137: 11, 138: 12, 139: 13, 140: 14, 141: 15, 142: 16, 143: 17, 144: 2, 145: 3, 146: 4, 147: 5, 148: 6, 149: 7, 150: 8, 151: 9, 152: 10, 153: 11, 154: 12, 155: 13, 156: 14, 157: 15, 158: 16, 159: 17, 160: 0, 161: 0, 162: 0, 163: 0, 164: 0, 240: 1, 241: 1, 242: 1, 243: 0, 244: 0, 255: 0}
+
+CALL_OPS = (compiler.CALL, compiler.CALLCODE, compiler.DELEGATECALL, compiler.STATICCALL)
+
 def opinfo(opcode):
     if opcode in opcodes.keys():
         return opcodes[opcode]
     return "INVALID",0,0,0
 
+class Annotations(object):
+    """ Dict-like view (annotation type -> annotation) of the annotations of an Annotable """
+    __slots__ = ('owner',)
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def __contains__(self, kind):
+        return self.get(kind) is not None
+
+    def __getitem__(self, kind):
+        value = self.get(kind)
+        if value is None:
+            raise KeyError(kind)
+        return value
+
+    def __setitem__(self, kind, value):
+        slot = ANNOTATION_SLOTS.get(kind)
+        if slot is not None:
+            setattr(self.owner, slot, value)
+        else:
+            if self.owner._extra is None:
+                self.owner._extra = {}
+            self.owner._extra[kind] = value
+
+    def get(self, kind, default = None):
+        slot = ANNOTATION_SLOTS.get(kind)
+        if slot is not None:
+            value = getattr(self.owner, slot)
+        elif self.owner._extra is not None:
+            value = self.owner._extra.get(kind)
+        else:
+            value = None
+        return default if value is None else value
+
+
 class Annotable(object):
+    """ The common annotations (see ANNOTATION_SLOTS) are kept in slots, any others in a dict
+    which is only created when needed. """
+    __slots__ = ('reaching', 'reaches', 'varname', '_extra')
+
     def __init__(self):
-        self.annotations = {}
-        super(Annotable, self).__init__()
+        self.reaching = None
+        self.reaches = None
+        self.varname = None
+        self._extra = None
+
+    @property
+    def annotations(self):
+        return Annotations(self)
 
     def setAnnotation(self, obj):
         self.annotations[type(obj)] = obj
 
 
 class OpcodeNode(Annotable):
+    __slots__ = ('pc', 'opcode', 'depth', 'info', 'args', 'result')
+
     def __init__(self, pc, depth, opcode, args, result):
         super(OpcodeNode, self).__init__()
         self.pc = pc
         self.opcode = opcode
         self.depth = depth
-        self.opname, self.ins, self.outs, self.gas = opinfo(opcode)
+        # (opname, ins, outs, gas), shared with the opcodes table
+        self.info = opinfo(opcode)
         self.args = args
         self.result = result
 
+    @property
+    def opname(self):
+        return self.info[0]
+
+    @property
+    def ins(self):
+        return self.info[1]
+
+    @property
+    def outs(self):
+        return self.info[2]
+
+    @property
+    def gas(self):
+        return self.info[3]
+
     def __str__(self):
         if self.opname in OPCODE_FORMATS:
             fmt = OPCODE_FORMATS[self.opname].format(*self.args)
@@ -78,12 +156,16 @@ class OpcodeNode(Annotable):
             return fmt
 
 class CallNode(OpcodeNode):
+    __slots__ = ('ops',)
+
     def __init__(self, pc, depth, opcode, args, result, ops):
         super(CallNode, self).__init__(pc, depth, opcode, args, result)
         self.ops = ops
 
 
 class PushNode(OpcodeNode):
+    __slots__ = ()
+
     def __init__(self, pc, depth, opcode, args, result):
         super(PushNode, self).__init__(pc, depth, opcode, args, result)
 
@@ -96,49 +178,68 @@ class PushNode(OpcodeNode):
 
 def buildAST(trace):
     ops = []
-    stack = []
-    pc = 0
-
-    for step in trace:
-        pc = step.get('pc', pc)
-        if step['op'] in opcodes.keys():
-            opname, ins, outs, gas = opcodes[step['op']]
-        else:
-            opname, ins, outs,gas = "INVALID",0,0,0
-
-        if ins > 0:
-            args = stack[-ins:][::-1]
-            stack = stack[:-ins]
-        else:
-            args = []
-        if 'ops' in step:
-            ops.append(CallNode(pc, step['depth'], step['op'], args, step['result'], buildAST(step['ops'])))
-        elif opname.startswith('PUSH'):
-            ops.append(PushNode(pc, step['depth'], step['op'], args, step['result']))
-        else:
-            ops.append(OpcodeNode(pc, step['depth'], step['op'], args, step['result']))
-        pc += step.get('len', 1)
-        stack.extend(step['result'][::-1])
+    # (steps, ops) of the frames still to build, the calls are built after their parent
+    pending = [(trace, ops)]
+
+    while pending:
+        (steps, frameops) = pending.pop()
+        stack = []
+        pc = 0
+
+        for step in steps:
+            pc = step.get('pc', pc)
+            if step['op'] in opcodes.keys():
+                opname, ins, outs, gas = opcodes[step['op']]
+            else:
+                opname, ins, outs,gas = "INVALID",0,0,0
+
+            if ins > 0:
+                args = stack[-ins:][::-1]
+                del stack[-ins:]
+            else:
+                args = []
+            if 'ops' in step:
+                op = CallNode(pc, step['depth'], step['op'], args, step['result'], [])
+                pending.append((step['ops'], op.ops))
+            elif opname.startswith('PUSH'):
+                op = PushNode(pc, step['depth'], step['op'], args, step['result'])
+            else:
+                op = OpcodeNode(pc, step['depth'], step['op'], args, step['result'])
+            frameops.append(op)
+            pc += step.get('len', 1)
+            stack.extend(step['result'][::-1])
     return ops
 
 
 class TransactionTrace(Annotable):
+    __slots__ = ('ops', '_checkpoints')
+
+    # lines between the saved iterator states used to start rendering at any line
+    CHECKPOINT_INTERVAL = 1000
+
     def __init__(self, ops):
         super(TransactionTrace, self).__init__()
         self.ops = ops
+        self._checkpoints = None
 
     @classmethod
     def build(cls, trace):
         return TransactionTrace(buildAST(trace))
 
     def __str__(self):
-        lines = []
-        stack = [(self, 0)]
+        return '\n'.join(self.lines())
+
+    @staticmethod
+    def formatLine(indent, op):
+        return "{0:>4} 0x{1:0>4x} {2}{3}".format(op.depth, op.pc, '  ' * indent, str(op))
+
+    def _walk(self, stack):
+        """ Yields (stack, call, i, op) for each line, from the iterator state `stack` """
         while stack:
             call, startidx = stack.pop()
             for i in range(startidx, len(call.ops)):
                 op = call.ops[i]
-                lines.append("{0:>4} 0x{1:0>4x} {2}{3}".format(op.depth,op.pc, '  '*len(stack), str(op)))
+                yield (stack, call, i, op)
                 if hasattr(op, 'ops'):
                     stack.append((call, i + 1))
                     stack.append((op, 0))
@@ -147,26 +248,69 @@ class TransactionTrace(Annotable):
                     stack.append((call, i + 1))
                     stack.append((op.expression, 0))
                     break
-        return '\n'.join(lines)
 
-    def iterator(self):
-        #lines = []
+    def _getCheckpoints(self):
+        """ Returns the iterator state at every CHECKPOINT_INTERVAL lines, and the number of lines """
+        if self._checkpoints is None:
+            checkpoints = []
+            n = 0
+            for (stack, call, i, op) in self._walk([(self, 0)]):
+                if n % self.CHECKPOINT_INTERVAL == 0:
+                    checkpoints.append(stack + [(call, i)])
+                n = n + 1
+            self._checkpoints = (checkpoints, n)
+        return self._checkpoints
+
+    def lineCount(self):
+        return self._getCheckpoints()[1]
+
+    def iterator(self, start = 0):
+        """ Yields (indentation, op) for the lines of the trace, from line `start` """
         stack = [(self, 0)]
-        while stack:
-            call, startidx = stack.pop()
-            for i in range(startidx, len(call.ops)):
-                op = call.ops[i]
-                yield (len(stack), op)
-                #lines.append("0x{0:0>4x} {1}{2}".format(op.pc, '  '*len(stack), str(op)))
-                if hasattr(op, 'ops'):
-                    stack.append((call, i + 1))
-                    stack.append((op, 0))
-                    break
-                elif hasattr(op, 'expression') and hasattr(op.expression, 'ops'):
-                    stack.append((call, i + 1))
-                    stack.append((op.expression, 0))
-                    break
-        #return '\n'.join(lines)
+        skip = start
+        if start > 0:
+            (checkpoints, count) = self._getCheckpoints()
+            if start >= count:
+                return
+            n = start // self.CHECKPOINT_INTERVAL
+            stack = list(checkpoints[n])
+            skip = start - n * self.CHECKPOINT_INTERVAL
+
+        for (stack, call, i, op) in self._walk(stack):
+            if skip > 0:
+                skip = skip - 1
+                continue
+            yield (len(stack), op)
+
+    def lines(self, start = 0, stop = None):
+        """ Yields the rendered lines `start` to `stop` (exclusive) of the trace """
+        n = start
+        for (indent, op) in self.iterator(start):
+            if stop is not None and n >= stop:
+                break
+            yield self.formatLine(indent, op)
+            n = n + 1
+
+    def render(self, start = 0, stop = None):
+        """ Returns the lines `start` to `stop` (exclusive) of the trace, as text """
+        return '\n'.join(self.lines(start, stop))
+
+    def write(self, out, start = 0, stop = None, bufsize = 1000):
+        """ Writes the lines `start` to `stop` (exclusive) to the file-like object `out` as they
+        are rendered, `bufsize` lines at a time. The output is the same as str() of the trace.
+        Returns the number of lines written. """
+        buf = []
+        n = 0
+        for line in self.lines(start, stop):
+            # lines are separated, not terminated, by newlines
+            buf.append(line if n == 0 else '\n' + line)
+            n = n + 1
+            if len(buf) >= bufsize:
+                out.write(''.join(buf))
+                buf = []
+        if buf:
+            out.write(''.join(buf))
+        return n
 
 
 class ReachingDefinitions(list):
@@ -181,7 +325,17 @@ class VariableName(str):
     """Annotation for variable name assignments."""
 
 
+# annotation type -> slot of Annotable it is stored in
+ANNOTATION_SLOTS = {
+    ReachingDefinitions: 'reaching',
+    ReachesDefinitions:  'reaches',
+    VariableName:        'varname',
+}
+
+
 class AssignmentStatement(object):
+    __slots__ = ('pc', 'depth', 'varname', 'expression')
+
     def __init__(self, depth, pc, varname, expression):
         self.pc = pc
         self.depth = depth
@@ -193,6 +347,8 @@ class AssignmentStatement(object):
 
 
 class ExpressionStatement(object):
+    __slots__ = ('pc', 'depth', 'expression')
+
     def __init__(self, depth, pc, expression):
         self.pc = pc
         self.depth = depth
@@ -202,7 +358,23 @@ class ExpressionStatement(object):
         return str(self.expression)
 
 
+def renderExpression(expression):
+    """ Returns the text of an expression. Nested expressions are rendered with an explicit
+    stack (see parts()), so the depth of the expression isn't limited by the recursion limit. """
+    out = []
+    stack = [expression]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+        else:
+            stack.extend(reversed(item.parts()))
+    return ''.join(out)
+
+
 class VariableExpression(object):
+    __slots__ = ('varname', 'depth')
+
     def __init__(self, depth, varname):
         self.varname = varname
         self.depth = depth
@@ -210,8 +382,13 @@ class VariableExpression(object):
     def __str__(self):
         return self.varname
 
+    def parts(self):
+        return [self.varname]
+
 
 class OperationExpression(object):
+    __slots__ = ('op', 'depth', 'args')
+
     def __init__(self, depth, op, args):
         self.op = op
         self.depth = depth
@@ -226,19 +403,38 @@ class OperationExpression(object):
         return self.op.pc
 
     def __str__(self):
-        if self.op.opname in OPCODE_FORMATS:
-            return OPCODE_FORMATS[self.op.opname].format(*self.args)
+        return renderExpression(self)
+
+    def parts(self):
+        """ Returns the text of this expression as a list of strings and sub-expressions """
+        parts = []
+        if self.op.opname in OPCODE_FORMAT_PARTS:
+            for (literal, i) in OPCODE_FORMAT_PARTS[self.op.opname]:
+                if literal:
+                    parts.append(literal)
+                if i is not None:
+                    parts.append(self.args[i])
         else:
-            return "{0}({1})".format(self.opname, ', '.join(map(str, self.args)))
+            parts.append(self.opname + "(")
+            for (i, arg) in enumerate(self.args):
+                if i > 0:
+                    parts.append(", ")
+                parts.append(arg)
+            parts.append(")")
+        return parts
 
 
 class CallExpression(OperationExpression):
+    __slots__ = ('ops',)
+
     def __init__(self, depth,op, args, ops):
         super(CallExpression, self).__init__(depth, op, args)
         self.ops = ops
 
 
 class LiteralExpression(OperationExpression):
+    __slots__ = ('value',)
+
     def __init__(self, depth, value):
         self.value = value
         self.depth = depth
@@ -246,30 +442,43 @@ class LiteralExpression(OperationExpression):
     def __str__(self):
         return self.value
 
+    def parts(self):
+        return [self.value]
+
+
+def reachOp(op, stack):
+    """ Annotates the op with the ops whose outputs it consumes (and vice versa), given the
+    stack of defining ops before it. Updates the stack in place. """
+    if op.ins > 0:
+        args = stack[-op.ins:]
+        del stack[-op.ins:]
+    else:
+        args = []
+    if op.opname.startswith('DUP'):
+        stack.extend(args)
+        stack.append(args[0])
+    elif op.opname.startswith('SWAP'):
+        stack.append(args[-1])
+        stack.extend(args[1:-1])
+        stack.append(args[0])
+    else:
+        for arg in args:
+            arg.reaches.append(op)
+        op.reaching = ReachingDefinitions(args[::-1])
+        op.reaches = ReachesDefinitions()
+        stack.extend([op] * op.outs)
+
 
 def findReachings(ast):
-    stack = []
-    for op in ast.ops:
-        if op.ins > 0:
-            args = stack[-op.ins:]
-            stack = stack[:-op.ins]
-        else:
-            args = []
-        if op.opname.startswith('DUP'):
-            stack.extend(args)
-            stack.append(args[0])
-        elif op.opname.startswith('SWAP'):
-            stack.append(args[-1])
-            stack.extend(args[1:-1])
-            stack.append(args[0])
-        else:
-            for arg in args:
-                arg.annotations[ReachesDefinitions].append(op)
-            op.setAnnotation(ReachingDefinitions(args[::-1]))
-            op.setAnnotation(ReachesDefinitions())
-            stack.extend([op] * op.outs)
-        if hasattr(op, 'ops'):
-            findReachings(op)
+    # the frames are independent, so the calls are annotated after their parent
+    pending = [ast]
+    while pending:
+        frame = pending.pop()
+        stack = []
+        for op in frame.ops:
+            reachOp(op, stack)
+            if hasattr(op, 'ops'):
+                pending.append(op)
 
 
 def nameIterator():
@@ -281,24 +490,38 @@ def nameIterator():
         prefix = next(prefixIterator)
 
 
-def buildExpression(op):
-    subexps = []
-    for arg in op.annotations[ReachingDefinitions]:
-        if VariableName in arg.annotations:
-            subexps.append(VariableExpression(op.depth, arg.annotations[VariableName]))
+def _buildExpression(root, pending):
+    """ Builds the expression of the op, with an explicit stack of the ops whose arguments
+    are being built. The ops of calls are left empty, and (call ops, expression ops) are
+    added to `pending` to be composed by the caller. """
+    # (op, expressions of its arguments built so far)
+    stack = [(root, [])]
+    while True:
+        (op, subexps) = stack[-1]
+        args = op.annotations[ReachingDefinitions]
+        if len(subexps) < len(args):
+            arg = args[len(subexps)]
+            if VariableName in arg.annotations:
+                subexps.append(VariableExpression(op.depth, arg.annotations[VariableName]))
+            else:
+                stack.append((arg, []))
+            continue
+
+        stack.pop()
+        if isinstance(op, CallNode):
+            expression = CallExpression(op.depth, op, subexps, [])
+            pending.append((op.ops, expression.ops))
+        elif isinstance(op, PushNode):
+            expression = LiteralExpression(op.depth, op.result[0])
         else:
-            subexps.append(buildExpression(arg))
-    if isinstance(op, CallNode):
-        return CallExpression(op.depth, op, subexps, composeOperations(op.ops))
-    elif isinstance(op, PushNode):
-        return LiteralExpression(op.depth, op.result[0])
-    else:
-        return OperationExpression(op.depth, op, subexps)
+            expression = OperationExpression(op.depth, op, subexps)
+        if not stack:
+            return expression
+        stack[-1][1].append(expression)
 
 
-def composeOperations(ops):
+def _composeFrame(ops, statements, pending):
     varnames = nameIterator()
-    statements = []
     for op in ops:
         # Ignore SWAP and DUP, which don't have annotations
         if ReachingDefinitions not in op.annotations:
@@ -306,11 +529,31 @@ def composeOperations(ops):
         reaches = op.annotations[ReachesDefinitions]
         if not op.opname.startswith('PUSH'):
             if len(reaches) == 0:
-                statements.append(ExpressionStatement(op.depth, op.pc, buildExpression(op)))
+                statements.append(ExpressionStatement(op.depth, op.pc, _buildExpression(op, pending)))
             elif len(reaches) > 1 or isinstance(op, CallNode):
                 varname = next(varnames)
                 op.setAnnotation(VariableName(varname))
-                statements.append(AssignmentStatement(op.depth, op.pc, varname, buildExpression(op)))
+                statements.append(AssignmentStatement(op.depth, op.pc, varname, _buildExpression(op, pending)))
+
+
+def _composePending(pending):
+    # The frames of calls are independent (with their own variable names), so they are
+    # composed after the expression of the call, rather than recursively
+    while pending:
+        (ops, statements) = pending.pop()
+        _composeFrame(ops, statements, pending)
+
+
+def buildExpression(op):
+    pending = []
+    expression = _buildExpression(op, pending)
+    _composePending(pending)
+    return expression
+
+
+def composeOperations(ops):
+    statements = []
+    _composePending([(ops, statements)])
     return statements
 
 
@@ -324,9 +567,8 @@ def trace(web3, txid, compose = True):
     return ast
 
 def traceEvmOutput(tracefile, compose = True):
-    result = evmResult(tracefile)
-    ast = TransactionTrace.build(result)
-    findReachings(ast)
+    with open(tracefile) as f:
+        ast = TransactionTrace(streamAST(f))
     if compose: 
         ast = TransactionTrace(composeOperations(ast.ops))
  
@@ -340,7 +582,6 @@ def evmResult(tracefile):
     res = {
         'stack' : [{"ops" : []}]
     }
-    npushes = {0: 0, 1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1, 8: 1, 9: 1, 10: 1, 11: 1, 16: 1, 17: 1, 18: 1, 19: 1, 20: 1, 21: 1, 22: 1, 23: 1, 24: 1, 25: 1, 26: 1, 32: 1, 48: 1, 49: 1, 50: 1, 51: 1, 52: 1, 53: 1, 54: 1, 55: 0, 56: 1, 57: 0, 58: 1, 59: 1, 60: 0, 61: 1, 62: 0, 64: 1, 65: 1, 66: 1, 67: 1, 68: 1, 69: 1, 80: 0, 81: 1, 82: 0, 83: 0, 84: 1, 85: 0, 86: 0, 87: 0, 88: 1, 89: 1, 90: 1, 91: 0, 96: 1, 97: 1, 98: 1, 99: 1, 100: 1, 101: 1, 102: 1, 103: 1, 104: 1, 105: 1, 106: 1, 107: 1, 108: 1, 109: 1, 110: 1, 111: 1, 112: 1, 113: 1, 114: 1, 115: 1, 116: 1, 117: 1, 118: 1, 119: 1, 120: 1, 121: 1, 122: 1, 123: 1, 124: 1, 125: 1, 126: 1, 127: 1, 128: 2, 129: 3, 130: 4, 131: 5, 132: 6, 133: 7, 134: 8, 135: 9, 136: 10, 137: 11, 138: 12, 139: 13, 140: 14, 141: 15, 142: 16, 143: 17, 144: 2, 145: 3, 146: 4, 147: 5, 148: 6, 149: 7, 150: 8, 151: 9, 152: 10, 153: 11, 154: 12, 155: 13, 156: 14, 157: 15, 158: 16, 159: 17, 160: 0, 161: 0, 162: 0, 163: 0, 164: 0, 240: 1, 241: 1, 242: 1, 243: 0, 244: 0, 255: 0}
 
     with open(tracefile) as f:
         for line in f:
@@ -358,7 +599,7 @@ def evmResult(tracefile):
             d = ' '.ljust(log['depth']*4)
 
             if log['depth'] != len(res['stack']):
-                res['stack'] = res['stack'][0:-1]
+                res['stack'].pop()
             #print("line", line)
             try:
                 frame = res['stack'][-1]
@@ -375,7 +616,7 @@ def evmResult(tracefile):
                 }
                 if len(frame['ops']) > 0:
                     prevop = frame['ops'][-1]
-                    for i in range(0,npushes[prevop['op']]):
+                    for i in range(0,NPUSHES[prevop['op']]):
                         prevop['result'].append(hex(peek(i)))
 
                 if isOp(compiler.CALL) or isOp(compiler.CALLCODE) or isOp(compiler.DELEGATECALL) or isOp(compiler.STATICCALL):
@@ -413,6 +654,80 @@ def evmResult(tracefile):
                 frame['ops'].append(opinfo)
 
         
+
+class _Frame(object):
+    """ A call frame while streaming a trace into the AST """
+    def __init__(self, ops):
+        self.ops = ops
+        self.pc = 0
+        # the simulated stack of values (as in buildAST) and of the ops defining them (as in findReachings)
+        self.values = []
+        self.defs = []
+
+
+def streamAST(lines):
+    """ Builds the AST of an evm trace (one json object per line) in a single pass, without
+    the intermediate evmResult tree. The ops are annotated with their reaching definitions
+    (as by findReachings) as they are read. Returns the ops of the outermost frame. """
+    ops = []
+    frames = [_Frame(ops)]
+    # stack item -> normalized hex value, to share the strings of repeated values
+    hexes = {}
+
+    for line in lines:
+        if not line.strip():
+            continue
+        log = json.loads(line)
+        if 'output' in log:
+            break
+
+        depth = log['depth']
+        if depth != len(frames):
+            frames.pop()
+        frame = frames[-1]
+        if depth != len(frames):
+            continue
+
+        stack = log['stack']
+        if frame.ops:
+            # the results of the previous op in this frame are on top of the stack now
+            prev = frame.ops[-1]
+            n = NPUSHES.get(prev.opcode, prev.outs)
+            if n > 0:
+                result = []
+                for item in stack[-1:-1 - n:-1]:
+                    value = hexes.get(item)
+                    if value is None:
+                        value = hexes[item] = hex(int(item, 16))
+                    result.append(value)
+                prev.result = tuple(result)
+                frame.values.extend(result[::-1])
+
+        opcode = log['op']
+        opname, ins, outs, gas = opinfo(opcode)
+        values = frame.values
+        if ins > 0:
+            args = values[-ins:][::-1]
+            del values[-ins:]
+        else:
+            args = []
+
+        pc = log['pc'] if opcode == compiler.JUMPDEST else frame.pc
+        # the result is set when the next op in the frame is read
+        if opcode in CALL_OPS:
+            op = CallNode(pc, depth, opcode, args, (), [])
+            frames.append(_Frame(op.ops))
+        elif opname.startswith('PUSH'):
+            op = PushNode(pc, depth, opcode, args, ())
+        else:
+            op = OpcodeNode(pc, depth, opcode, args, ())
+        frame.pc = pc + (opcode - 0x5e if compiler.PUSH1 <= opcode <= compiler.PUSH32 else 1)
+
+        reachOp(op, frame.defs)
+        frame.ops.append(op)
+    return ops
+
+
 def testFile(fname):
     testfile = os.path.join(os.path.dirname(__file__), fname)
     ast = traceEvmOutput(testfile)
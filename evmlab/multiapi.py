@@ -1,6 +1,9 @@
 
-import shelve, traceback
+import traceback, threading, pickle
+from concurrent.futures import ThreadPoolExecutor, Future
+from hexbytes import HexBytes
 from . import utils
+from .apicache import StateCache, MemoryCache
 
 class MultiApi(object):
 
@@ -9,37 +12,130 @@ class MultiApi(object):
 
     web3 is a bit better, since it allows for querying about balance
     and things at specified block height.
+
+    If `rpc` (a BatchRpc for the same node as web3) is given, the account and storage
+    lookups are instead sent as JSON-RPC batches, one http request per batch lookup.
     """
 
-    def __init__(self, web3 = None, etherchain = None):
+    TX_TRANSLATIONS = [("sender", "from"),
+                       ("recipient", "to"),
+                       ("block_id", "blockNumber" )]
+
+    def __init__(self, web3 = None, etherchain = None, workers = 8, cache = None, rpc = None):
         self.web3 = web3
         self.etherchain = etherchain
+        self.rpc = rpc
+        # max number of concurrent requests for the batch lookups
+        self.workers = workers
+        # The cache can be shared between several MultiApi instances
+        self.cache = cache if cache is not None else MemoryCache(StateCache())
+        # key -> Future, for the lookups currently being fetched
+        self._inflight = {}
+        self._inflightLock = threading.Lock()
+
+    @staticmethod
+    def _accountKey(address, blnum):
+        return ("account", address.lower(), blnum, "")
+
+    @staticmethod
+    def _slotKey(address, key, blnum):
+        return ("storage", address.lower(), blnum, str(key))
+
+    def _fetchAll(self, fn, args):
+        """ Performs the lookups `fn(*a)` for each `a` in args concurrently,
+        and returns the results in the same order """
+        if len(args) < 2:
+            return [fn(*a) for a in args]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(args))) as executor:
+            return list(executor.map(lambda a: fn(*a), args))
+
+    def _fetchCached(self, keys, fn, args, cacheable, batch = False):
+        """ Looks up all keys in the cache with one query, fetches the misses
+        concurrently with `fn` and stores them with one write.
+        If `batch` is set, `fn` is instead called once, with the list of args of all misses.
+
+        If another thread is already fetching a key, the result of that
+        fetch is awaited instead of fetching it again. Each waiter gets its
+        own copy of the result.
+        """
+        cached = self.cache.getMany(keys) if cacheable else {}
+        results = [cached.get(key) for key in keys]
+
+        own = []
+        waiting = []
+        with self._inflightLock:
+            for (i, key) in enumerate(keys):
+                if key in cached:
+                    continue
+                future = self._inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    own.append(i)
+                else:
+                    waiting.append((i, future))
 
-    def _getCached(self,key):
-        db = shelve.open(".api_cache")
-        obj = None
-        if key in db:
-            obj = db[key]
-        db.close()
-        return obj
+        try:
+            todo = [args[i] for i in own]
+            if batch:
+                fetched = fn(todo) if todo else []
+            else:
+                fetched = self._fetchAll(fn, todo)
+        except Exception as e:
+            self._resolve([keys[i] for i in own], exception=e)
+            raise
 
-    def _putCached(self,key, obj):
-        db = shelve.open(".api_cache")
-        db[key] = obj
-        db.close()
+        if cacheable:
+            self.cache.putMany({keys[i]: value for (i, value) in zip(own, fetched) if value is not None})
+        self._resolve([keys[i] for i in own], fetched)
+
+        for (i, value) in zip(own, fetched):
+            results[i] = value
+        for (i, future) in waiting:
+            results[i] = pickle.loads(future.result())
+        return results
+
+    def _resolve(self, keys, values = None, exception = None):
+        """ Completes the in-flight lookups of `keys`. The values are passed pickled,
+        so that the fetching thread and the waiters don't share mutable results """
+        with self._inflightLock:
+            futures = [self._inflight.pop(key) for key in keys]
+        for (n, future) in enumerate(futures):
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(pickle.dumps(values[n], pickle.HIGHEST_PROTOCOL))
+
+    def getAccountInfos(self, addresses, blnum = None):
+        """ Fetches several accounts at once, returns a list in the same order """
+        addresses = list(addresses)
+        if self.rpc is not None:
+            return self._fetchCached([self._accountKey(addr, blnum) for addr in addresses],
+                                     self._batchAccountInfos, [(addr, blnum) for addr in addresses],
+                                     cacheable = blnum is not None, batch = True)
+        return self._fetchCached([self._accountKey(addr, blnum) for addr in addresses],
+                                 self._fetchAccountInfo, [(addr, blnum) for addr in addresses],
+                                 cacheable = blnum is not None and self.web3 is not None)
+
+    def getStorageSlots(self, slots, blnum = None):
+        """ Fetches several storage slots at once.
+        `slots` is a list of (address, key), returns the values in the same order """
+        slots = list(slots)
+        values = self._fetchCached([self._slotKey(addr, key, blnum) for (addr, key) in slots],
+                                 self._batchStorageSlots if self.rpc is not None else self._fetchStorageSlot,
+                                 [(addr, key, blnum) for (addr, key) in slots],
+                                 cacheable = blnum is not None, batch = self.rpc is not None)
+        # failed lookups are not cached
+        return ["" if v is None else v for v in values]
 
     def getAccountInfo(self, address, blnum = None):
+        return self.getAccountInfos([address], blnum)[0]
+
+    def _fetchAccountInfo(self, address, blnum = None):
         acc = {}
 
-        
         print("GetAccountInfo(%s, %s)"% (address, str(blnum)))
 
-        if blnum is not None: 
-            cachekey = "%s-%d" % (address, blnum)
-            cached = self._getCached(cachekey)
-            if cached is not None:
-                return cached
-
         if self.web3 is not None:
             # web3 only accepts checksummed addresses
             chk_address = utils.checksumAddress(address) 
@@ -52,67 +148,148 @@ class MultiApi(object):
             if acc['code'] == '0x0':
                 acc['code'] = '0x'
 
-            # cache it, but only if it's at a specific block number
-            if blnum is not None:
-                self._putCached(cachekey, acc)
-
         elif self.etherchain is not None: 
             acc = self.etherchain.getAccount(address)
 
         return acc
 
-    def getTransaction(self,h):
+    @staticmethod
+    def _blockParam(blnum):
+        return "latest" if blnum is None else hex(blnum)
+
+    def _batchAccountInfos(self, args):
+        """ Fetches balance, code and nonce of all (address, blnum) in args, with one batch request """
+        print("GetAccountInfos(%d accounts)" % len(args))
+        calls = []
+        for (address, blnum) in args:
+            block = self._blockParam(blnum)
+            calls.append(("eth_getBalance", [address, block]))
+            calls.append(("eth_getCode", [address, block]))
+            calls.append(("eth_getTransactionCount", [address, block]))
+        results = self.rpc.batch(calls)
+
+        accounts = []
+        for (n, (address, blnum)) in enumerate(args):
+            (balance, code, nonce) = results[3 * n:3 * n + 3]
+            # testrpc will return 0x0 if no code, geth expects 0x
+            if code == '0x0':
+                code = '0x'
+            accounts.append({'balance': int(balance, 16),
+                             'code': HexBytes(code),
+                             'nonce': int(nonce, 16),
+                             'address': address})
+        return accounts
 
-        cachekey = "tx-%s" % h
+    def _batchStorageSlots(self, args):
+        """ Fetches all (address, key, blnum) in args, with one batch request """
+        print("GetStorageSlots(%d slots)" % len(args))
+        calls = [("eth_getStorageAt", [addr, hex(key) if isinstance(key, int) else key, self._blockParam(blnum)])
+                 for (addr, key, blnum) in args]
+        values = []
+        for result in self.rpc.batch(calls, errors = False):
+            if isinstance(result, Exception):
+                print("ERROR OCCURRED: trace may not be correct: %s" % result)
+                values.append(None)
+            else:
+                values.append(HexBytes(result))
+        return values
 
-        o = self._getCached(cachekey)
-        if o is not None:
-            return o
+    def getTransaction(self,h):
+        return self._fetchCached([("tx", h.lower(), -1, "")], self._fetchTransaction, [(h,)], True)[0]
 
-        translations = [("sender", "from"),
-                        ("recipient", "to"),
-                        ("block_id", "blockNumber" )]
+    def _fetchTransaction(self, h):
 
         if self.web3 : 
             obj = self.web3.eth.getTransaction(h)
-            obj_dict = {}
-            for a in obj:
-              obj_dict[a] = obj[a]
-            for (a,b) in translations:
-                obj_dict[a] = obj_dict[b]
+            return self._translateTransaction(obj)
 
         else:
             obj = self.etherchain.getTransaction(h)
             obj_dict = {key: value for (key, value) in obj}
-            for (a,b) in translations:
+            for (a,b) in self.TX_TRANSLATIONS:
                 obj_dict[b] = obj_dict[a]
+            return obj_dict
 
-        self._putCached( cachekey, obj_dict)
+    def _translateTransaction(self, obj):
+        obj_dict = {}
+        for a in obj:
+          obj_dict[a] = obj[a]
+        for (a,b) in self.TX_TRANSLATIONS:
+            obj_dict[a] = obj_dict[b]
         return obj_dict
 
+    def getBlockTransactions(self, blnum):
+        """ Returns the transactions of the block, in order, with one request.
+        The transactions are also cached, so a subsequent getTransaction doesn't need a request """
+        if self.web3 is None:
+            raise Exception("getBlockTransactions requires web3 to be configured")
+
+        block = self.web3.eth.getBlock(blnum, True)
+        txs = [self._translateTransaction(obj) for obj in block['transactions']]
+        for tx in txs:
+            if not isinstance(tx['hash'], str):
+                tx['hash'] = tx['hash'].hex()
+        self.cache.putMany({("tx", tx['hash'].lower(), -1, ""): tx for tx in txs})
+        return txs
+
+    def scoped(self, maxentries = 1000000, maxbytes = 1024 * 1024 * 1024):
+        """ Returns a MultiApi using the same backends, with a separate in-memory cache in
+        front of this one's cache. Used to share a working set (e.g. the state of one block)
+        between several lookups, without evicting other entries from this cache. """
+        return MultiApi(web3 = self.web3, etherchain = self.etherchain, workers = self.workers,
+                        cache = MemoryCache(self.cache, maxentries = maxentries, maxbytes = maxbytes),
+                        rpc = self.rpc)
+
     def getStorageSlot(self, addr, key, blnum = None):
+        return self.getStorageSlots([(addr, key)], blnum)[0]
 
-        print("GetStorageSlot(%s, %s, %s)"% (addr, key, str(blnum)))
+    def _fetchStorageSlot(self, addr, key, blnum = None):
 
-        if blnum is not None: 
-            cachekey = "%s-%d-%s" % (addr,blnum,key)
-            cached = self._getCached(cachekey)
-            if cached is not None:
-                return cached
+        print("GetStorageSlot(%s, %s, %s)"% (addr, key, str(blnum)))
 
         if self.web3:
             try:
-                value = self.web3.eth.getStorageAt(addr, key, blnum)
-                self._putCached(cachekey, value)
-                return value
+                return self.web3.eth.getStorageAt(addr, key, blnum)
             except Exception as e:
                 print("ERROR OCCURRED: trace may not be correct")    
                 traceback.print_exc()
-                return ""
+                return None
             
         else:
             print("getStorageSlot not implemented for etherchain api")
-            return ""
+            # None, so that it is not cached
+            return None
+
+    def getPrestate(self, tx):
+        """ Returns all accounts touched by the transaction (balance, code, nonce and the
+        storage slots accessed), as they were before the transaction, with a single
+        debug_traceTransaction call using the 'prestateTracer'.
+        The accounts are in the format of `Genesis.addPrestateAccount`.
+
+        Raises an exception if the node does not support it.
+        """
+        return self._fetchCached([("prestate", tx.lower(), -1, "")], self._fetchPrestate, [(tx,)], True)[0]
+
+    def _fetchPrestate(self, tx):
+        result = self.traceTransaction(tx, tracer="prestateTracer")
+        accounts = []
+        for address in result:
+            acc = result[address]
+            balance = acc.get('balance', 0)
+            if not isinstance(balance, str):
+                balance = hex(balance)
+            nonce = acc.get('nonce', 0)
+            if not isinstance(nonce, str):
+                nonce = hex(nonce)
+            accounts.append({
+                'address': address,
+                'balance': balance,
+                'code':    acc.get('code', '0x') or '0x',
+                'nonce':   nonce,
+                'storage': dict(acc.get('storage', {})),
+            })
+
+        return accounts
 
     def traceTransaction(self, tx, disableStorage=False, disableMemory=False, disableStack=False, tracer=None,
                                timeout=None):
@@ -14,7 +14,7 @@ This is a tool to replicate live on-chain events. It starts with a transaction i
 """
 
 import json
-import tempfile, os, traceback
+import tempfile, os, traceback, time, logging
 
 from sys import argv, exit
 
@@ -22,92 +22,31 @@ from . import compiler as c
 from . import genesis as gen
 from . import opcodes
 from . import evmtrace
+from .traceindex import TraceIndex
 #from . import multiapi
 from . import utils
 
-def findExternalCalls(list_of_output):
-    externals = {
-                "CALL"         : lambda o : o['stack'][-2], 
-                "CALLCODE"     : lambda o : o['stack'][-2], 
-                "DELEGATECALL" : lambda o : o['stack'][-2], 
-                "STATICCALL"   : lambda o : o['stack'][-2], 
-                "EXTCODECOPY"  : lambda o : o['stack'][-1],
-                "EXTCODESIZE"  : lambda o : o['stack'][-1],
-                "BALANCE"      : lambda o : o['stack'][-1],
-                }
-    accounts = set()
+logger = logging.getLogger(__name__)
+
+def parseTrace(list_of_output):
+    """ Parses the json lines of an EVM-output into a list of ops, so that the output
+    only needs to be parsed once for all lookups """
+    ops = []
     for l in list_of_output:
         if len(l) == 0 or l[0] != "{":
-            print("Odd line: %s" % l)
+            logger.debug("Odd line: %s" % l)
             continue
+        ops.append(json.loads(l.strip()))
+    return ops
 
-        o = json.loads(l.strip())
-
-        if 'opName' in o and o['opName'] in externals.keys():
-            accounts.add(externals[o['opName']](o))
-
-    accounts.discard('0x0')
-    return accounts
+def findExternalCalls(list_of_output):
+    return TraceIndex(parseTrace(list_of_output)).externals
 
 def findStorageLookups(list_of_output, original_context):
-    """ This method searches through an EVM-output and locates SLOAD queries
-    Returns a list of (<address>, <key>)
+    """ This method searches through the ops of an EVM-output and locates SLOAD queries
+    Returns a set of (<address>, <key>)
     """
-    # call context
-    context = [] 
-    # duplicate avoidance
-    refs = set()
-
-    # In order to do this, we need to track the context (address) we're executing in
-    callstack = []
-
-    cur_depth = 1
-    prev_depth = 1
-    prev_op = None
-    cur_address = original_context
-
-    for l in list_of_output:
-        if len(l) == 0 or l[0] != "{":
-            continue
-
-        o = json.loads(l.strip())
-        if not 'depth' in o.keys():
-            #We're done here
-            break
-        # Address tracking - what's the context we're executing in
-        cur_depth = o['depth']
-        if cur_depth > prev_depth:
-            #Made it into a call-variant
-            callstack.append(cur_address)
-            # All call-lookalikes are 'gas,address,value' on stack, 
-            # so address is second item of prev line
-            #
-            # There's two exceptions, though; CREATE and DELEGATECALL
-            # With a CREATE, we don't know the address until after the RETURN
-            # and it isn't necessary to load storage b/c it hasn't been initialized
-            # After a DELEGATECALL, we've increased the depth, 
-            # but still operating on the same context, regardless of the
-            # address that was invoked
-            if prev_op['op'] == 0xf0:
-                cur_address = None
-            elif prev_op['op'] != 0xf4:
-                cur_address = prev_op['stack'][-2]
-
-        if cur_depth < prev_depth:
-            # Returned from a call
-            cur_address = callstack.pop()
-
-        # Sload tracking
-        if cur_address and (o['opName'] in ['SLOAD','SSTORE'] or o['op'] in [0x54, 0x55]):
-
-            key  = o['stack'][-1]
-            entry = (cur_address, key)
-            refs.add(entry)
-
-        prev_op = o
-        prev_depth = cur_depth
-
-    return refs
+    return TraceIndex(parseTrace(list_of_output), original_context).storage
 
 
 def debugdump(obj):
@@ -115,7 +54,14 @@ def debugdump(obj):
     pprint.PrettyPrinter().pprint(obj)
 
 
-def reproduceTx(txhash, vm, api):
+def reproduceTx(txhash, vm, api, prestate = True):
+    """ Reproduces the transaction locally. 
+
+    If `prestate` is set and the node supports it, the prestate is fetched with a single
+    'prestateTracer' call. Otherwise, the prestate is discovered by executing the 
+    transaction, fetching the accounts and slots it accessed, and repeating until no new
+    ones are found.
+    """
 
     genesis = gen.Genesis()
     
@@ -153,13 +99,29 @@ def reproduceTx(txhash, vm, api):
 
     storage_slots_fetched = set()
     slots_to_fetch = set()
+
+    if prestate:
+        try:
+            accounts = api.getPrestate(txhash)
+            for acc in accounts:
+                genesis.addPrestateAccount(acc)
+            print("Loaded prestate of %d accounts from node" % len(accounts))
+            # Nothing left to discover, go straight to the final execution
+            externals_fetched.update(externals_tofetch)
+            externals_tofetch = set()
+        except Exception as e:
+            print("Prestate not available from node (%s), discovering it by execution" % e)
     receivercode = ""
     done = False
+    rounds = 0
     while not done:
         done = True
-        # Add accounts that we know of 
-        for addr in list(externals_tofetch):
-            acc = api.getAccountInfo( addr , blnum - 1)  # need to load accountInfo at block before tx
+        rounds = rounds + 1
+        round_start = time.time()
+        # Add accounts that we know of, everything found in the previous round is fetched at once
+        addresses = list(externals_tofetch)
+        # need to load accountInfo at block before tx
+        for acc in api.getAccountInfos(addresses, blnum - 1):
             genesis.add(acc)
             #debugdump(acc)
             done = False
@@ -167,11 +129,14 @@ def reproduceTx(txhash, vm, api):
         
         externals_fetched.update(externals_tofetch)
 
-        for (addr,key) in list(slots_to_fetch):
-            val = api.getStorageSlot( addr, int(key,16), blnum - 1)  # need to load storage at block before tx
+        slots = list(slots_to_fetch)
+        # need to load storage at block before tx
+        values = api.getStorageSlots([(addr, int(key,16)) for (addr, key) in slots], blnum - 1)
+        for ((addr,key), val) in zip(slots, values):
             genesis.addStorage(addr, key, val)
             done = False
         storage_slots_fetched.update(slots_to_fetch)
+        fetch_done = time.time()
         
         (g_path, p_path) = genesis.export(txhash[:8])
         genesis_path = g_path
@@ -199,6 +164,7 @@ def reproduceTx(txhash, vm, api):
         #receivercode = genesis.codeAt(r)
         #print(tx)
         output =  vm.execute(**vm_args)
+        execution_done = time.time()
 
         fd, temp_path = tempfile.mkstemp( prefix=txhash[:8]+'_', suffix=".txt")
         with open(temp_path, 'w') as f :
@@ -207,18 +173,25 @@ def reproduceTx(txhash, vm, api):
         os.close(fd)
 
         if not done:
+            # The output is parsed and indexed once, for both lookups
+            index = TraceIndex(parseTrace(output), r)
+
             # External accounts to lookup
-            externals_found = findExternalCalls(output)
+            externals_found = index.externals
             externals_tofetch = externals_found.difference(externals_fetched)
             if len(externals_tofetch) > 0:
                 print("External accounts to fetch: %s " % externals_tofetch )
 
             # Storage slots to lookup
-            slots_found = findStorageLookups(output, r)
+            slots_found = index.storage
             slots_to_fetch = slots_found.difference(storage_slots_fetched)
             if len(slots_to_fetch) > 0:
                 print("SLOTS to fetch: %s " % slots_to_fetch)
 
+        print("Round %d: fetched %d accounts and %d slots in %.2fs, executed in %.2fs, analysed in %.2fs" % (
+            rounds, len(addresses), len(slots),
+            fetch_done - round_start, execution_done - fetch_done, time.time() - execution_done))
+
 
     artefacts = {
         'geth genesis'   : g_path, 
@@ -229,7 +202,8 @@ def reproduceTx(txhash, vm, api):
         annotated_trace = evmtrace.traceEvmOutput(temp_path)
         fd, a_trace = tempfile.mkstemp( prefix=txhash[:8]+'_', suffix=".evmtrace.txt")
         with open(a_trace, 'w') as f :
-            f.write(str(annotated_trace))
+            # written as the lines are rendered, rather than as one string
+            annotated_trace.write(f)
         os.close(fd)
         artefacts['annotated trace'] = a_trace
 
@@ -241,6 +215,62 @@ def reproduceTx(txhash, vm, api):
     print(vm_args)
     return artefacts, vm_args
 
+def reproduceBlock(blocknumber, vm, api, workers = 4, prestate = True):
+    """ Reproduces all transactions of a block, `workers` at a time.
+
+    The transactions of the block are fetched with one request, and all reproductions
+    share one block-scoped cache, so accounts and slots used by several transactions
+    are only fetched once. When the prestate is not taken from the node, the senders
+    and receivers are prefetched up front, at the state of the previous block.
+
+    Note: without the prestate from the node, each transaction is executed on the state
+    at the end of the previous block, i.e. not including the changes made by earlier
+    transactions in the same block.
+
+    Returns a list of (txhash, artefacts, vm_args), in block order. If reproducing
+    a transaction failed, its artefacts and vm_args are None.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    blockapi = api.scoped()
+    txs = blockapi.getBlockTransactions(blocknumber)
+    print("Block %d: %d transactions" % (blocknumber, len(txs)))
+
+    prefetch = not prestate
+    if prestate and len(txs) > 0:
+        # The prestate of the first transaction is cached for its reproduction; if the
+        # node can't provide it, the accounts are discovered by execution instead
+        try:
+            blockapi.getPrestate(txs[0]['hash'])
+        except Exception:
+            prefetch = True
+
+    if prefetch:
+        addresses = set()
+        for tx in txs:
+            addresses.add(tx['from'])
+            if tx['to'] not in [None, '0x0']:
+                addresses.add(tx['to'])
+        blockapi.getAccountInfos(sorted(addresses), blocknumber - 1)
+
+    def reproduce(tx):
+        try:
+            (artefacts, vm_args) = reproduceTx(tx['hash'], vm, blockapi, prestate = prestate)
+            return (tx['hash'], artefacts, vm_args)
+        except Exception as e:
+            print("Reproducing %s failed" % tx['hash'])
+            traceback.print_exc()
+            return (tx['hash'], None, None)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        results = list(executor.map(reproduce, txs))
+
+    failed = len([r for r in results if r[1] is None])
+    print("Block %d: reproduced %d transactions (%d failed) in %.2fs, cache %s" % (
+        blocknumber, len(results), failed, time.time() - start, blockapi.cache.stats()))
+    return results
+
 def testStoreLookup():
     tr = "/data/workspace/evmlab/0xd6d519043d40691a36c9e718e47110309590e6f47084ac0ec00b53718e449fd3_der80goh.txt"
     with open(tr, "r") as f:
@@ -0,0 +1,99 @@
+"""
+Minimal JSON-RPC client, which sends batches of calls over a pooled keep-alive session
+"""
+import json, time, threading, itertools, logging
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class RpcError(Exception):
+
+    def __init__(self, method, error):
+        self.method = method
+        self.error = error
+        super(RpcError, self).__init__("%s failed: %s" % (method, error))
+
+
+class BatchRpc(object):
+    """ JSON-RPC client which can send several calls in one http request.
+
+    Connections are kept alive and pooled (up to `poolsize`, for use from several threads).
+    Requests which fail due to connection errors, timeouts or a 429/5xx status are retried
+    up to `retries` times, with an exponential backoff starting at `backoff` seconds.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, timeout = 60, retries = 3, backoff = 0.5, poolsize = 16, maxbatch = 500):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # max number of calls in one http request
+        self.maxbatch = maxbatch
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self._ids = itertools.count(1)
+        self._idLock = threading.Lock()
+
+    def _post(self, payload):
+        data = json.dumps(payload)
+        attempt = 0
+        while True:
+            try:
+                r = self.session.post(self.url, data=data, timeout=self.timeout)
+                if r.status_code not in self.RETRY_STATUS:
+                    r.raise_for_status()
+                    return r.json()
+                error = "HTTP %d" % r.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt >= self.retries:
+                raise Exception("JSON-RPC request to %s failed after %d attempts: %s" % (self.url, attempt + 1, error))
+            delay = self.backoff * (2 ** attempt)
+            logger.warning("JSON-RPC request failed (%s), retrying in %.1fs" % (error, delay))
+            time.sleep(delay)
+            attempt = attempt + 1
+
+    def call(self, method, params):
+        return self.batch([(method, params)])[0]
+
+    def batch(self, calls, errors = True):
+        """ Performs the calls, a list of (method, params), and returns the results in the same order.
+        If a call fails, an RpcError is raised, or if `errors` is False, the RpcError is returned
+        in place of the result. """
+        results = []
+        for i in range(0, len(calls), self.maxbatch):
+            chunk = calls[i:i + self.maxbatch]
+            with self._idLock:
+                ids = [next(self._ids) for _ in chunk]
+            payload = [{"jsonrpc": "2.0", "id": id, "method": method, "params": params}
+                       for (id, (method, params)) in zip(ids, chunk)]
+            response = self._post(payload)
+            if isinstance(response, dict):
+                # Some nodes answer a failed batch with a single error
+                raise RpcError(chunk[0][0], response.get('error', response))
+
+            # The responses may come in any order
+            byId = {r.get('id'): r for r in response}
+            for (id, (method, params)) in zip(ids, chunk):
+                r = byId.get(id)
+                if r is None:
+                    result = RpcError(method, "no response")
+                elif 'error' in r:
+                    result = RpcError(method, r['error'])
+                else:
+                    result = r.get('result')
+                if errors and isinstance(result, RpcError):
+                    raise result
+                results.append(result)
+        return results
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,122 @@
+"""
+Precomputed index of a source text: line offsets, lines and contract boundaries
+"""
+import re
+import threading
+from collections import OrderedDict
+from bisect import bisect_right
+
+CONTRACT_PATTERN = re.compile('^ *contract ')
+
+
+class SourceIndex(object):
+    """ Index of a source text, computed once per text and shared (see `SourceIndex.of`).
+
+    Answers which line an offset is on by bisection of the line start offsets, and
+    caches the split lines and the contract boundaries.
+    """
+
+    # the most recently used indexes, by text
+    _indexes = OrderedDict()
+    _lock = threading.Lock()
+    maxIndexes = 32
+
+    def __init__(self, text):
+        self.text = text
+        # offsets where each line starts
+        self.lineOffsets = [0]
+        pos = text.find('\n')
+        while pos >= 0:
+            self.lineOffsets.append(pos + 1)
+            pos = text.find('\n', pos + 1)
+        self.contractStarts = [m.start(0) for m in CONTRACT_PATTERN.finditer(text)]
+        self._lines = None
+        self._joined = None
+        self._contracts = {}
+
+    @classmethod
+    def of(cls, text):
+        """ Returns the (shared) index of the text. Only the `maxIndexes` most recently
+        used indexes are kept """
+        with cls._lock:
+            index = cls._indexes.get(text)
+            if index is not None:
+                cls._indexes.move_to_end(text)
+                return index
+        index = SourceIndex(text)
+        with cls._lock:
+            index = cls._indexes.setdefault(text, index)
+            cls._indexes.move_to_end(text)
+            while len(cls._indexes) > cls.maxIndexes:
+                cls._indexes.popitem(last=False)
+        return index
+
+    @property
+    def lines(self):
+        """ The text split into lines (str.splitlines) """
+        if self._lines is None:
+            self._lines = self.text.splitlines()
+        return self._lines
+
+    def lineOf(self, offset):
+        """ Returns the (0-based) line of the offset, i.e. the number of newlines before it """
+        return bisect_right(self.lineOffsets, offset) - 1
+
+    def newlinesBetween(self, start, end):
+        """ Returns the number of newlines in text[start:end] """
+        return self.lineOf(end) - self.lineOf(start)
+
+    def joinedLength(self, n):
+        """ Returns len("\\n".join(self.lines[:n])) """
+        if self._joined is None:
+            joined = [0]
+            for l in self.lines:
+                joined.append(joined[-1] + len(l) + 1)
+            self._joined = joined
+        n = min(n, len(self.lines))
+        return max(self._joined[n] - 1, 0)
+
+    def contractRange(self, s):
+        """ For source texts with several contracts, returns the (start, end, text) of the
+        contract containing the offset `s`. Returns None if there is only one contract. """
+        starts = self.contractStarts
+        if len(starts) <= 1:
+            return None
+
+        contract_start = 0
+        for i in starts:
+            if i == s:
+                contract_start = s
+                break
+            elif i > s:
+                # get the previous index
+                ci = starts.index(i) - 1
+                if ci >= 0:
+                    contract_start = starts[ci]
+                break
+            elif s > i and i == starts[-1]:
+                contract_start = starts[-1]
+
+        if contract_start not in self._contracts:
+            contract_end = self._contractEnd(contract_start)
+            self._contracts[contract_start] = (contract_start, contract_end,
+                                               self.text[contract_start:contract_end])
+        return self._contracts[contract_start]
+
+    def _contractEnd(self, contract_start):
+        c = self.text
+        pos = c.find('{', contract_start)
+        if pos < 0:
+            pos = contract_start - 1
+        openBr = 0
+        while pos < len(c):
+            if c[pos] == '{':
+                openBr += 1
+            elif c[pos] == '}':
+                openBr -= 1
+
+            if openBr == 0:
+                return pos + 1
+
+            pos += 1
+        return -1
@@ -1,6 +1,9 @@
+from array import array
 from functools import reduce
 import json
 
+from .source_index import SourceIndex
+
 
 def int_or_none(v):
     if v in ('i', 'o', '-'):
@@ -31,7 +34,12 @@ class SourceMap(object):
         self.source = source
         self.data = data
         self.contract = contract
-        self.source_line_offsets = self._compute_source_line_offsets(source)
+        self.source_index = SourceIndex.of(source)
+        self.source_line_offsets = self.source_index.lineOffsets
+        # the srcmap is parsed once, see _compute_srcmap_arrays
+        self._srcmap = self._fill_srcmap(data['contracts'][contract]['srcmap-runtime'])
+        self._compute_srcmap_arrays(self._srcmap)
+        self._instr_lines = None
         self.byte_to_instr = self._compute_byte_to_instr()
 
     @classmethod
@@ -47,8 +55,17 @@ class SourceMap(object):
 
     @property
     def srcmap(self):
-        _srcmap = self.data['contracts'][self.contract]['srcmap-runtime']
-        return self._fill_srcmap(_srcmap)
+        return self._srcmap
+
+    def _compute_srcmap_arrays(self, elems):
+        # parallel arrays of the srcmap entries per instruction, -1 (or ' ' for jumps) for missing values
+        def value(v):
+            return -1 if v is None else v
+
+        self.starts = array('i', (value(e[0]) for e in elems))
+        self.lengths = array('i', (value(e[1]) for e in elems))
+        self.files = array('i', (value(e[2]) for e in elems))
+        self.jumps = "".join(e[3] or ' ' for e in elems)
 
     def _fill_srcmap(self, srcmap):
         elems = srcmap.split(';')
@@ -65,43 +82,41 @@ class SourceMap(object):
         return elems
 
     def _compute_byte_to_instr(self):
-        result = []
+        result = array('i')
+        code = self.bin
         byte_idx = 0
         instr_idx = 0
 
-        while byte_idx < len(self.bin):
-            length = instruction_length(self.bin[byte_idx])
-            for i in range(length):
-                result.append(instr_idx)
+        while byte_idx < len(code):
+            length = instruction_length(code[byte_idx])
+            result.extend([instr_idx] * length)
             byte_idx += length
             instr_idx += 1
 
         return result
 
-    def _compute_source_line_offsets(self, source):
-        offsets = [0]
-        for i in range(len(source)):
-            if source[i] == '\n':
-                offsets.append(i+1)
-        return offsets
+    def _line_number_for_offset(self, offset):
+        if offset < 0:
+            # not within the source
+            return len(self.source_line_offsets)
+        return self.source_index.lineOf(offset) + 1
 
     def line_number_for_instr(self, instr):
-        offset = self.srcmap[instr][0]
+        return self._line_number_for_offset(self.starts[instr])
 
-        prev_n = self.source_line_offsets[0]
-        ln = 1
-        for n in self.source_line_offsets[1:]:
-            if offset >= prev_n and offset < n:
-                return ln
-            prev_n = n
-            ln += 1
-        return ln
+    def line_numbers_for_pcs(self, pcs):
+        """ Returns the (1-based) source line numbers for a sequence of pcs, e.g. all steps of a trace """
+        if self._instr_lines is None:
+            self._instr_lines = array('i', map(self._line_number_for_offset, self.starts))
+        instr_lines = self._instr_lines
+        byte_to_instr = self.byte_to_instr
+        return array('i', [instr_lines[byte_to_instr[pc]] for pc in pcs])
 
     def instr_for_pc(self, pc):
         return self.byte_to_instr[pc]
 
     def line_for_instr(self, instr):
-        offset = self.srcmap[instr][0]
+        offset = self.starts[instr]
 
         start = self.source.rfind('\n', 0, offset)
         end = self.source.find('\n', offset)
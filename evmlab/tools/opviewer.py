@@ -7,12 +7,15 @@ import os
 import json
 import argparse, math
 import logging
+import collections
 
 from evmlab.context import buildContexts
 from evmlab.contract import Contract
+from evmlab.source_index import SourceIndex
 from evmlab import reproduce, utils
 from evmlab import vm as VMUtils
 from evmlab.opcodes import reverse_opcodes
+from evmlab.tracefile import LazyTrace, MemoryTrace
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +61,12 @@ class Console:
 class DebugViewer(object):
     # todo: review staticmethods and check if they really belong to debugviewer (visualization vs. generic helper)
 
+    # rendered pane contents, formatted trace lines, hexdump rows and memory (as hex) kept
+    PANE_CACHE_SIZE = 256
+    TRACE_CACHE_SIZE = 1024
+    MEMROW_CACHE_SIZE = 4096
+    MEMORY_CACHE_SIZE = 4
+
     def __init__(self):
 
         self.memptr = 0
@@ -75,6 +84,29 @@ class DebugViewer(object):
         self.source_view = None
         self.help_view = None
 
+        # pane name -> content currently shown
+        self._shown = {}
+        # (pane name, inputs) -> rendered content
+        self._panes = collections.OrderedDict()
+        # op index -> line in the trace pane
+        self._traceLines = collections.OrderedDict()
+        # (row, memory row, previous memory row) -> hexdump row
+        self._memRows = {}
+        # op index -> memory as hex
+        self._memHex = collections.OrderedDict()
+
+    @staticmethod
+    def _cached(cache, key, fn, size):
+        """ Returns cache[key], computed by fn() if missing. Keeps the `size` most recently used. """
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = fn()
+        cache[key] = value
+        if len(cache) > size:
+            cache.popitem(last=False)
+        return value
+
     @staticmethod
     def wrap(x, y):
         return urwid.LineBox(x, y)
@@ -160,16 +192,14 @@ class DebugViewer(object):
 
             start = code_pos[0]
             end = start + code_pos[1]
-            code = contract[start:end]
+            index = SourceIndex.of(contract)
 
             # determine which line the code is on
-            start_code_line = contract[:start].count('\n')
-            # start_code_line = len(re.findall(NEWLINE_PATTERN, contract[:start]))
+            start_code_line = index.lineOf(start)
             # num of lines of code
-            code_lines = code.count('\n') + 1
-            # code_lines = len(re.findall(NEWLINE_PATTERN, code)) + 1
+            code_lines = index.newlinesBetween(start, end) + 1
 
-            split = contract.splitlines()
+            split = index.lines
 
             if track:
                 if start_code_line == 0 or code_lines >= length:
@@ -192,7 +222,7 @@ class DebugViewer(object):
             # highlight the current code in the view
 
             # determine the code start offset for the view
-            code_start_offset = start - len("\n".join(split[:srcptr])) - 1
+            code_start_offset = start - index.joinedLength(srcptr) - 1
             code_end_offset = code_start_offset + code_pos[1]
             if (code_start_offset <= 0):
                 # current code starts before the view
@@ -317,9 +347,10 @@ class DebugViewer(object):
         return []
 
     @staticmethod
-    def hexdump(src, length=16, sep='.', minrows=8, start=0, prevsrc=""):
+    def hexdump(src, length=16, sep='.', minrows=8, start=0, prevsrc="", rowcache=None):
         """
         @brief Return {src} in hex dump.
+        Rows which are the same as in a previous dump are reused from {rowcache}, if given
         """
         txt = lambda c: chr(c) if 0x20 <= c < 0x7F else "."
 
@@ -330,6 +361,17 @@ class DebugViewer(object):
 
         for i in xrange(0, 16):
             subSrc = src[2 * (start * 16 + i * 16):2 * (start * 16 + i * 16) + length * 2]
+            if rowcache is not None:
+                # the row only depends on its address, data and the previous data there
+                prevSub = None
+                if prevsrc is not None:
+                    prevSub = prevsrc[2 * (start + i) * 16:2 * (start + i) * 16 + len(subSrc)]
+                key = (start + i, subSrc, prevSub)
+                if key in rowcache:
+                    rows.append(rowcache[key])
+                    if len(rows) == minrows:
+                        break
+                    continue
             hexa = ''
             text = ''
             if len(subSrc) > 0:
@@ -354,6 +396,8 @@ class DebugViewer(object):
                     text += txt(byte)
 
             rows.append('{:08x}:  {:<49} | {:<16} '.format(16 * (start + i), hexa, text))
+            if rowcache is not None:
+                rowcache[key] = rows[-1]
             if len(rows) == minrows:
                 break
         result.extend(rows)
@@ -484,6 +528,13 @@ class DebugViewer(object):
         """
         @brief formats a list of instructions to a table
         """
+        return DebugViewer.opTraceLines([DebugViewer.toText(op) for op in ops], sel, offset)
+
+    @staticmethod
+    def opTraceLines(lines, sel=0, offset=0):
+        """
+        @brief formats a list of formatted instructions (see toText) to a table
+        """
         header = "|".join(["step    ",
                            " pc   ",
                            "  opname  ",
@@ -494,17 +545,19 @@ class DebugViewer(object):
                            ])
         result = [header, ""]
 
-        for i, op in enumerate(ops):
+        for i, line in enumerate(lines):
             if i + offset == sel:
-                result.append("{:<4} >> {}".format(i + offset, DebugViewer.toText(op)))
+                result.append("{:<4} >> {}".format(i + offset, line))
             else:
-                result.append("{:<4}    {}".format(i + offset, DebugViewer.toText(op)))
+                result.append("{:<4}    {}".format(i + offset, line))
 
         return "\n".join(result)
 
-    def setTrace(self, trace, op_contracts=[], txhash=None, txinput=None):
+    def setTrace(self, trace, op_contracts=[], txhash=None, txinput=None, memory=None):
         self.operations = trace
         self.op_contracts = op_contracts
+        # MemoryTrace, if the memory isn't stored in the ops
+        self.memory = memory
 
         ops_view = urwid.Text(self.getOp())
         mem_view = urwid.Text(self.getMem())
@@ -608,17 +661,34 @@ class DebugViewer(object):
 
         return DebugViewer.opDump(self._op(default={'pc': 1}), addr)
 
+    def _memory(self, prev=False):
+        """ Returns the memory of the current (or previous) op as a hex string """
+        if self.memory is None:
+            m = self._prevop('memory', "0x") if prev else self._op('memory', "0x")
+            if type(m) is list:
+                m = "0x%s" % "".join(m)
+            return m
+        if prev:
+            if self.opptr > len(self.operations) - 2:
+                return "0x"
+            step = self.opptr - 1
+        else:
+            if self.opptr > len(self.operations) - 1:
+                return "0x"
+            step = self.opptr
+        # cached by step, so that stepping by one reuses the memory of the previous op
+        return DebugViewer._cached(self._memHex, step % len(self.operations),
+                                   lambda: self.memory.hex(step), self.MEMORY_CACHE_SIZE)
+
     def getMem(self):
-        m = self._op('memory', "0x")
-        if type(m) is list:
-            m = "0x%s" % "".join(m)
-        prev_m = self._prevop('memory', "0x")
-        if type(prev_m) is list:
-            prev_m = "0x%s" % "".join(prev_m)
-        return DebugViewer.hexdump(m[2:], start=self.memptr, prevsrc=prev_m[2:])
+        m = self._memory()
+        prev_m = self._memory(prev=True)
+        if len(self._memRows) > self.MEMROW_CACHE_SIZE:
+            self._memRows.clear()
+        return DebugViewer.hexdump(m[2:], start=self.memptr, prevsrc=prev_m[2:], rowcache=self._memRows)
 
     def _getMemref(self, bound):
-        m = self._op('memory', [])
+        m = self._memory()
         mc = ""
         mc_prev = ""
         ms = DebugViewer.getMemoryReference(self._op('op', "0"))
@@ -647,8 +717,9 @@ class DebugViewer(object):
 
         end = min(start + 2 * pad + 1, len(self.operations) - 1)
 
-        ops = self.operations[start: end]
-        return DebugViewer.opTrace(ops=ops, sel=sel, offset=start)
+        lines = [DebugViewer._cached(self._traceLines, i, lambda: DebugViewer.toText(self.operations[i]),
+                                     self.TRACE_CACHE_SIZE) for i in range(start, end)]
+        return DebugViewer.opTraceLines(lines, sel=sel, offset=start)
 
     def getSource(self, track=None):
 
@@ -679,18 +750,38 @@ class DebugViewer(object):
     press `q` to quit
         """
 
+    def _pane(self, name, inputs, fn):
+        """ Returns the content of a pane, rendered by fn() unless cached for the same inputs """
+        return DebugViewer._cached(self._panes, (name, inputs), fn, self.PANE_CACHE_SIZE)
+
+    def _show(self, name, view, content):
+        """ Sets the content of a pane, unless it's already shown """
+        if self._shown.get(name) != content:
+            view.set_text(content)
+            self._shown[name] = content
+
+    def _refreshMem(self):
+        self._show('mem', self.mem_view, self._pane('mem', (self.opptr, self.memptr), self.getMem))
+
+    def _refreshStack(self):
+        self._show('stack', self.stack_view, self._pane('stack', (self.opptr, self.stackptr), self.getStack))
+
+    def _refreshSource(self, track=None):
+        # not cached, as it depends on (and moves) srcptr; the lines of the source are indexed once
+        self._show('source', self.source_view, self.getSource(track=track))
+
     def _refresh(self):
-        self.source_view.set_text(self.getSource())  # needs to occur before getOp to print correct addr
-        self.ops_view.set_text(self.getOp())
-        self.trace_view.set_text(self.getTrace())
-        self.mem_view.set_text(self.getMem())
-        self.memref_view.set_text(self.getMemref())
-        self.stack_view.set_text(self.getStack())
-        self.help_view.set_text(self.getHelp())
+        self._refreshSource()  # needs to occur before getOp to print correct addr
+        self._show('ops', self.ops_view, self._pane('ops', self.opptr, self.getOp))
+        self._show('trace', self.trace_view, self._pane('trace', self.opptr, self.getTrace))
+        self._refreshMem()
+        self._show('memref', self.memref_view, self._pane('memref', self.opptr, self.getMemref))
+        self._refreshStack()
+        self._show('help', self.help_view, self.getHelp())
 
     def dbg(self, text):
         if self.help_view is not None:
-            self.help_view.set_text(text)
+            self._show('help', self.help_view, text)
 
     def show_or_exit(self, key):
         """
@@ -718,38 +809,38 @@ class DebugViewer(object):
         # UP mem
         if key in ('s', 'S'):
             self.memptr = max(0, self.memptr - step)
-            self.mem_view.set_text(self.getMem())
+            self._refreshMem()
 
         # DOWN mem
         if key in ('x', 'X'):
             self.memptr = self.memptr + step
-            self.mem_view.set_text(self.getMem())
+            self._refreshMem()
 
         # UP stack
         if key in ('d', 'D'):
             self.stackptr = max(0, self.stackptr - step)
-            self.stack_view.set_text(self.getStack())
+            self._refreshStack()
 
         # DOWN stack
         if key in ('c', 'C'):
             self.stackptr = self.stackptr + step
-            self.stack_view.set_text(self.getStack())
+            self._refreshStack()
 
         # UP source
         if key in ('f', 'F'):
             self.srcptr = max(0, self.srcptr - step)
-            self.source_view.set_text(self.getSource(track=False))
+            self._refreshSource(track=False)
 
         # DOWN source
         if key in ('v', 'V'):
             self.srcptr = self.srcptr + step
-            self.source_view.set_text(self.getSource(track=False))
+            self._refreshSource(track=False)
 
         if key in ('t', 'T'):
             self.srctrack = not self.srctrack
             if self.srctrack:
                 self.srcptr = 0
-            self.source_view.set_text(self.getSource())
+            self._refreshSource()
 
         if key in ('g', 'G'):
             self.dbg("TODO: Implement GOTO")
@@ -786,6 +877,8 @@ class EvmTrace(object):
 
         # internal state
         self.ops = []
+        # MemoryTrace of the ops, if the memory isn't stored in the ops
+        self.memory = None
         self.contracts = []
         self.op_contracts = []
 
@@ -818,7 +911,7 @@ class EvmTrace(object):
         if not self.ops:
             raise Exception("need to reproduce/load trace first")
 
-        DebugViewer().setTrace(self.ops, self.op_contracts, self.txhash, self.txinput)
+        DebugViewer().setTrace(self.ops, self.op_contracts, self.txhash, self.txinput, memory=self.memory)
 
     def reproduce(self, tx, vm):
         """
@@ -838,6 +931,7 @@ class EvmTrace(object):
         return self.load_trace(path=artefacts['json-trace'])
 
     def load_trace(self, tx=None, _json=None, path=None):
+        self.memory = None
         if _json:
             return self.load_trace_json(data=_json)
         elif tx:
@@ -856,21 +950,20 @@ class EvmTrace(object):
             # get rid of jsonrpc envelope if it is available
             data = data['result']
         xops = data['structLogs']
+        # The memory is stored as keyframes and deltas, instead of in every op
+        memory = MemoryTrace()
         for op in xops:
             newOp = dict(op)  # get rid of attributeDict if data comes from api
             newOp['opName'] = op['op']
             newOp['op'] = reverse_opcodes[op['op']]
 
-            if 'memory' in op.keys():
-                if op['memory'] is None:
-                    newOp['memory'] = "0x"
-                else:
-                    newOp['memory'] = "0x" + "".join(op['memory'])
-                    logger.debug("Memory set to %s" % newOp['memory'])
+            memory.append(newOp)
+            newOp.pop('memory', None)
             ops.append(newOp)
-        logger.debug("Loaded %d items from structlogs" % len(ops))
+        logger.debug("Loaded %d items from structlogs, memory in %d keyframes" % (len(ops), len(memory.keyframes)))
 
         self.ops = ops
+        self.memory = memory
         logger.debug("trace loaded (structLogs).")
         return self
 
@@ -879,24 +972,28 @@ class EvmTrace(object):
             raise Exception("%s - is not a file" % path)
 
         logger.debug("loading trace file: %s" % path)
+        #
+        # 1) try line-by-line json (geth format). The file is indexed, not loaded:
+        #    the ops are decoded when the viewer accesses them
+        #
+        try:
+            self.ops = LazyTrace(path)
+            self.memory = None
+            logger.debug("trace loaded (json objects, lazily)")
+            return self
+        except Exception as e:
+            logger.debug(e)
+
         with open(path) as f:
             #
-            # 1) try json tracefile
+            # 2) try json tracefile
             #
             try:
                 return self.load_trace_json(json.load(f))
             except json.decoder.JSONDecodeError:
                 logger.debug('Failed to parse file in debug_traceTransaction format')
-            #
-            # 2) try line-by-line json
-            #
-            logger.debug("Trying to load %s in geth format")
             f.seek(0)  # rewind
             data = f.read()
-            try:
-                return self._loadJsonObjects(data)
-            except Exception as e:
-                logger.debug(e)
             #
             # 3) try load weird json format
             #
@@ -907,28 +1004,6 @@ class EvmTrace(object):
 
         raise Exception("could not load json trace file")
 
-    def _loadJsonObjects(self, data):
-        """Load the json from geth `evm`"""
-
-        ops = []
-        for l in data.split("\n"):
-            l = l.strip()
-            if l.startswith("#"):
-                continue
-            if len(l) == 0:
-                continue
-            op = json.loads(l)
-            if 'action' in op.keys():
-                continue
-            ops.append(op)
-
-        if not ops:
-            raise Exception("could not load json line-by-line code")
-
-        self.ops = ops
-        logger.debug("trace loaded (json objects)")
-        return self
-
     def _loadWeirdJson(self, data):
         ops = []
 
@@ -6,9 +6,12 @@ import re
 import zipfile
 import tempfile
 import logging
+import threading
+import collections
 
 from evmlab import reproduce, utils
 from evmlab import vm as VMUtils
+from evmlab.tracefile import TextLines
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +25,9 @@ except ImportError:
 
 OUTPUT_DIR = tempfile.mkdtemp(prefix="evmlab")
 
+# lines per page when viewing an annotated trace
+TRACE_PAGESIZE = 500
+
 
 def create_zip_archive(input_files, output_archive):
     """
@@ -96,6 +102,46 @@ if app:
         return flask.send_from_directory(OUTPUT_DIR, filename, as_attachment=True)
 
 
+    # filename -> TextLines of the most recently viewed annotated traces
+    trace_files = collections.OrderedDict()
+    trace_files_lock = threading.Lock()
+
+    def get_trace_page(filename, page):
+        """ Returns (lines, start, total, page, pages) of a page of the annotated trace,
+        or None if there is no such trace. The lines are read while holding the lock, as
+        the file may be closed once it is evicted """
+        path = os.path.join(OUTPUT_DIR, os.path.basename(filename))
+        if not os.path.isfile(path):
+            return None
+        with trace_files_lock:
+            if path in trace_files:
+                trace_files.move_to_end(path)
+            else:
+                trace_files[path] = TextLines(path)
+                if len(trace_files) > 16:
+                    trace_files.popitem(last=False)[1].close()
+            lines = trace_files[path]
+            total = len(lines)
+            pages = (total + TRACE_PAGESIZE - 1) // TRACE_PAGESIZE
+            page = min(max(page, 0), max(pages - 1, 0))
+            start = page * TRACE_PAGESIZE
+            return (lines.lines(start, start + TRACE_PAGESIZE), start, total, page, pages)
+
+
+    @app.route('/trace/<filename>')
+    def view_trace(filename):
+        """ Shows an annotated trace one page at a time """
+        logger.debug("rendering view_trace...")
+        found = get_trace_page(filename, flask.request.args.get('page', 0, type=int))
+        if found is None:
+            flask.abort(404)
+        (lines, start, total, page, pages) = found
+        return flask.render_template("trace.html",
+                                     filename=filename, lines=lines,
+                                     start=start, stop=start + len(lines), total=total,
+                                     page=page, pages=pages)
+
+
 def test(vm, api):
     print("Doing tests")
     # Jumpdest-analysis attack
@@ -122,6 +168,9 @@ python3 reproducer.py --no-docker -g ~/go/src/github.com/ethereum/go-ethereum/bu
 # Reproduce a tx with a docker evm
 python3 reproducer.py -g holiman/gethvm --hash 0xd6d519043d40691a36c9e718e47110309590e6f47084ac0ec00b53718e449fd3
 
+# Reproduce all transactions in a block, four at a time
+python3 reproducer.py -g holiman/gethvm --block 4500000 --workers 4
+
 # Start the reproducer webapp using the default geth docker image: 
 python3 reproducer.py -w localhost
 
@@ -142,10 +191,18 @@ Unfinished:
 
     parser.add_argument("--no-docker", action="store_true",
                         help="Set to true if using a local binary instead of a docker image")
+    parser.add_argument("--no-prestate", action="store_true",
+                        help="Don't fetch the prestate with debug_traceTransaction (prestateTracer), always discover it by execution")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of transactions to reproduce in parallel with --block")
+    parser.add_argument("--pool", type=int, default=0,
+                        help="Keep this many docker containers running and execute in them, instead of starting a new container per execution")
 
     web_or_direct = parser.add_mutually_exclusive_group()
     web_or_direct.add_argument('-x', '--hash', type=str,
                                help="Don't run webapp, just lookup hash")
+    web_or_direct.add_argument('-b', '--block', type=int,
+                               help="Don't run webapp, reproduce all transactions in the block")
     if app:
         web_or_direct.add_argument('-w', '--www', type=str, help="Run webapp on given interface (interface:port)")
         parser.add_argument('-d', '--debug', action="store_true", default=False,
@@ -157,17 +214,19 @@ Unfinished:
     web3settings = parser.add_argument_group('Web3', 'Settings about where to fetch information from (default infura)')
     web3settings.add_argument("--web3", type=str, default="https://mainnet.infura.io/",
                               help="Web3 API url to fetch info from (default 'https://mainnet.infura.io/'")
+    web3settings.add_argument("--batch", action="store_true",
+                              help="Fetch accounts and storage with JSON-RPC batch requests")
 
     args = parser.parse_args()
 
     # end of arg handling
 
     if args.parity_evm:
-        vm = VMUtils.ParityVM(args.parity_evm, not args.no_docker)
+        vm = VMUtils.ParityVM(args.parity_evm, not args.no_docker, poolsize=args.pool)
     else:
-        vm = VMUtils.GethVM(args.geth_evm, not args.no_docker)
+        vm = VMUtils.GethVM(args.geth_evm, not args.no_docker, poolsize=args.pool)
 
-    api = utils.getApi(args.web3)
+    api = utils.getApi(args.web3, batch=args.batch)
 
     if args.test:
         artefacts = test(vm, api)
@@ -189,7 +248,7 @@ Unfinished:
         app.run(host=host, port=port)
 
     elif args.hash:
-        artefacts, vm_args = reproduce.reproduceTx(args.hash, vm, api)
+        artefacts, vm_args = reproduce.reproduceTx(args.hash, vm, api, prestate=not args.no_prestate)
         saved_files = utils.saveFiles(OUTPUT_DIR, artefacts)
 
         # Some tricks to get the right command for local replay
@@ -225,6 +284,22 @@ Unfinished:
 
         print("\nZipped files into %s" % output_archive)
 
+    elif args.block is not None:
+        results = reproduce.reproduceBlock(args.block, vm, api, workers=args.workers, prestate=not args.no_prestate)
+        print("")
+        for (txhash, artefacts, vm_args) in results:
+            if artefacts is None:
+                print("%s: failed" % txhash)
+                continue
+            # One set of artefacts per transaction
+            destination = os.path.join(OUTPUT_DIR, txhash) + "/"
+            os.makedirs(destination, exist_ok=True)
+            saved_files = utils.saveFiles(destination, artefacts)
+            output_archive = os.path.join(OUTPUT_DIR, "%s.zip" % txhash)
+            input_files = [(os.path.join(v['path'], v['name']), v['name']) for v in saved_files.values()]
+            create_zip_archive(input_files=input_files, output_archive=output_archive)
+            print("%s: zipped files into %s" % (txhash, output_archive))
+
     else:
         parser.print_usage()
 
@@ -0,0 +1,299 @@
+"""
+Random access to the ops of a (possibly very large) trace file with one json object per line,
+and to the lines of large text files such as annotated traces
+"""
+import os, json, mmap, array, collections
+
+from .traceindex import opNumber
+
+
+class LazyTrace(object):
+    """ Sequence of the ops in a line-by-line json trace file (as output by geth `evm --json`).
+
+    The file is memory-mapped and indexed in one pass; the ops are only decoded when accessed,
+    and the most recently used `cachesize` decoded ops are kept.
+
+    Raises an exception if the file isn't in that format. A line which turns out not to be
+    valid json when accessed later (e.g. one truncated by an interrupted client) is
+    returned as an op with an 'error'.
+    """
+
+    def __init__(self, path, cachesize = 1024):
+        self.path = path
+        self.cachesize = cachesize
+        self._cache = collections.OrderedDict()
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            self._file.close()
+            raise Exception("%s is empty" % path)
+        try:
+            (self.starts, self.ends) = self._index()
+        except:
+            self.close()
+            raise
+
+        if len(self) == 0:
+            self.close()
+            raise Exception("could not load json line-by-line code")
+        # Fail early if this is some other json format
+        try:
+            first = self._decode(0)
+        except ValueError:
+            first = None
+        if not isinstance(first, dict) or 'structLogs' in first or 'result' in first:
+            self.close()
+            raise Exception("not a line-by-line json trace")
+
+    def _index(self):
+        """ Returns the start and end offsets of the lines with json objects """
+        m = self._map
+        starts = array.array('Q')
+        ends = array.array('Q')
+        size = len(m)
+        pos = 0
+        while pos < size:
+            end = m.find(b"\n", pos)
+            if end < 0:
+                end = size
+            # skip leading whitespace
+            start = pos
+            while start < end and m[start] in b" \t\r":
+                start = start + 1
+            if start < end and m[start] != ord("#"):
+                if m[start] != ord("{"):
+                    raise Exception("not a line-by-line json trace, line at %d" % start)
+                # parity's trace lines aren't ops
+                if m.find(b'"action"', start, end) < 0:
+                    starts.append(start)
+                    ends.append(end)
+            pos = end + 1
+        return (starts, ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _decode(self, i):
+        return json.loads(self._map[self.starts[i]:self.ends[i]].decode())
+
+    def _op(self, i):
+        try:
+            return self._decode(i)
+        except ValueError as e:
+            return {'error': "malformed trace line: %s" % e}
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(len(self)))]
+        if i < 0:
+            i = i + len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("trace index out of range")
+
+        cache = self._cache
+        if i in cache:
+            cache.move_to_end(i)
+            return cache[i]
+        op = self._op(i)
+        cache[i] = op
+        if len(cache) > self.cachesize:
+            cache.popitem(last=False)
+        return op
+
+    def __iter__(self):
+        # Sequential scans don't go through the cache, to not evict the ops in use
+        for i in range(len(self)):
+            if i in self._cache:
+                yield self._cache[i]
+            else:
+                yield self._op(i)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class TextLines(object):
+    """ Random access to the lines of a text file, e.g. an annotated trace.
+
+    The file is memory-mapped and the line starts indexed in one pass; lines are only
+    decoded when accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = b""
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        m = self._map
+        self.starts = array.array('Q')
+        pos = 0
+        while pos < len(m):
+            self.starts.append(pos)
+            end = m.find(b"\n", pos)
+            if end < 0:
+                break
+            pos = end + 1
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lines(self, start, stop):
+        """ Returns the lines `start` to `stop` (exclusive), without newlines """
+        (start, stop, step) = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return []
+        end = self.starts[stop] if stop < len(self) else len(self._map)
+        data = self._map[self.starts[start]:end]
+        if data.endswith(b"\n"):
+            data = data[:-1]
+        return data.decode(errors="replace").split("\n")
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+
+def _stackInt(item):
+    return int(item, 16)
+
+# ops which write to memory: opcode -> (stack index of offset, stack index of size, or fixed size)
+# CALL-variants write their output area, when they return to the same depth (e.g. precompiles)
+MEMORY_WRITES = {
+    0x37: (-1, -3, None),  # CALLDATACOPY
+    0x39: (-1, -3, None),  # CODECOPY
+    0x3c: (-2, -4, None),  # EXTCODECOPY
+    0x3e: (-1, -3, None),  # RETURNDATACOPY
+    0x52: (-1, None, 32),  # MSTORE
+    0x53: (-1, None, 1),   # MSTORE8
+    0xf1: (-6, -7, None),  # CALL
+    0xf2: (-6, -7, None),  # CALLCODE
+    0xf4: (-5, -6, None),  # DELEGATECALL
+    0xfa: (-5, -6, None),  # STATICCALL
+}
+
+
+class MemoryTrace(object):
+    """ The memory of each step of a trace, stored as keyframes plus per-step write deltas.
+
+    A step's memory is stored in full (a keyframe) at the first step, whenever the depth
+    changes, and at least every `interval` steps. Otherwise only the area written by the
+    previous op (MSTORE, *COPY etc) and the new memory size are stored. If the memory
+    changed outside of that area, a keyframe is stored instead.
+    """
+
+    def __init__(self, interval = 256):
+        self.interval = interval
+        # step -> step of its keyframe
+        self.keyframeOf = array.array('q')
+        # keyframe step -> memory
+        self.keyframes = {}
+        # step -> (offset, data, size), None for keyframes
+        self.deltas = []
+        self._prev = None
+        self._prevDepth = None
+        self._prevOp = None
+        # recently reconstructed step -> memory, for stepping through the trace
+        self._recent = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.deltas)
+
+    @staticmethod
+    def _toBytes(memory):
+        """ Accepts the memory as a hex string (with or without 0x), or list of hex words """
+        if memory is None:
+            return b""
+        if isinstance(memory, list):
+            memory = "".join(memory)
+        if memory.startswith("0x"):
+            memory = memory[2:]
+        return bytes.fromhex(memory)
+
+    def append(self, op):
+        """ Adds the memory of the op (a step of the trace, as a dict) """
+        memory = self._toBytes(op.get('memory'))
+        step = len(self.deltas)
+        prev = self._prev
+        delta = None
+
+        keyframe = (prev is None or op.get('depth') != self._prevDepth
+                    or step - self.keyframeOf[-1] >= self.interval)
+        if not keyframe:
+            delta = self._delta(prev, memory, self._prevOp)
+            keyframe = delta is None
+
+        if keyframe:
+            self.keyframes[step] = memory
+            self.keyframeOf.append(step)
+        else:
+            self.keyframeOf.append(self.keyframeOf[-1])
+        self.deltas.append(delta)
+
+        self._prev = memory
+        self._prevDepth = op.get('depth')
+        self._prevOp = op
+
+    def _delta(self, prev, memory, prevOp):
+        """ Returns (offset, data, size) for the change from prev to memory, or None if
+        that isn't just a write to the area of the previous op (and expansion) """
+        size = len(memory)
+        if size < len(prev):
+            return None
+        (offset, end) = (0, 0)
+        write = MEMORY_WRITES.get(opNumber(prevOp)) if prevOp is not None else None
+        if write is not None:
+            try:
+                stack = prevOp['stack']
+                offset = _stackInt(stack[write[0]])
+                length = write[2] if write[1] is None else _stackInt(stack[write[1]])
+                end = min(offset + length, size) if length else offset
+            except (IndexError, KeyError, ValueError):
+                return None
+            if offset > size:
+                (offset, end) = (0, 0)
+
+        # Everything else must be unchanged, and expanded memory zeroed
+        if memory[:offset] != prev[:offset]:
+            return None
+        if memory[end:len(prev)] != prev[end:]:
+            return None
+        tail = max(end, len(prev))
+        if memory.count(0, tail) != size - tail:
+            return None
+        return (offset, memory[offset:end], size)
+
+    def get(self, step):
+        """ Returns the memory at the step, as bytes """
+        if step < 0:
+            step = step + len(self)
+        if step in self._recent:
+            return self._recent[step]
+        key = self.keyframeOf[step]
+        # Start from the closest step already reconstructed, or the keyframe
+        start = key
+        for s in self._recent:
+            if start < s < step and self.keyframeOf[s] == key:
+                start = s
+        memory = bytearray(self._recent[start] if start != key else self.keyframes[key])
+        start = start + 1
+
+        for i in range(start, step + 1):
+            (offset, data, size) = self.deltas[i]
+            if size > len(memory):
+                memory.extend(bytes(size - len(memory)))
+            memory[offset:offset + len(data)] = data
+
+        memory = bytes(memory)
+        self._recent[step] = memory
+        if len(self._recent) > 4:
+            self._recent.popitem(last=False)
+        return memory
+
+    def hex(self, step):
+        """ Returns the memory at the step as a hex string, prefixed with 0x """
+        return "0x" + self.get(step).hex()
@@ -0,0 +1,186 @@
+"""
+Index over the ops of an EVM trace, built in one pass: which address each op executes,
+the tree of call frames, the external accounts and storage slots that are accessed
+"""
+from . import opcodes
+
+CREATE = 0xf0
+CALLCODE = 0xf2
+RETURN = 0xf3
+DELEGATECALL = 0xf4
+CREATE2 = 0xf5
+
+# Where to find the address on the stack, for ops which access other accounts
+EXTERNALS = {
+    0xf1: -2,  # CALL
+    0xf2: -2,  # CALLCODE
+    0xf4: -2,  # DELEGATECALL
+    0xfa: -2,  # STATICCALL
+    0x3c: -1,  # EXTCODECOPY
+    0x3b: -1,  # EXTCODESIZE
+    0x31: -1,  # BALANCE
+}
+
+SLOAD = 0x54
+SSTORE = 0x55
+
+
+def opNumber(o):
+    """ Returns the opcode of an op, which is given by name in some traces (debug_traceTransaction) """
+    op = o.get('op')
+    if isinstance(op, str):
+        return opcodes.reverse_opcodes.get(op)
+    if op is None and 'opName' in o:
+        return opcodes.reverse_opcodes.get(o['opName'])
+    return op
+
+
+class Frame(object):
+    """ A call frame: the ops from `start` to `end` (exclusive) at one depth, except
+    those in the child frames.
+
+    `address` is the address whose code is executed, and `storageAddress` the account whose
+    storage is used (which differ for DELEGATECALL and CALLCODE). For frames started by CREATE,
+    both are None until the frame has returned the created address.
+    """
+
+    def __init__(self, op, address, storageAddress, depth, start, parent = None):
+        self.op = op
+        self.address = address
+        self.storageAddress = storageAddress
+        self.depth = depth
+        self.start = start
+        self.end = None
+        self.parent = parent
+        # position in TraceIndex.frames
+        self.index = None
+        self.children = []
+        # indexes of the ops which execute the address, if not known yet
+        self.placeholders = []
+
+    def __repr__(self):
+        return "Frame(%s, %s, depth %d, ops %d-%s)" % (
+            opcodes.opcodes[self.op][0] if self.op in opcodes.opcodes else self.op,
+            self.address, self.depth, self.start, self.end)
+
+
+class TraceIndex(object):
+    """ Index over the ops of a trace (json objects, as output by the evm), built in one pass.
+
+    For each op, `addresses[i]` is the address whose code is executed, `storageAddresses[i]` the
+    account whose storage is accessed and `frameOf[i]` the frame (index into `frames`).
+
+    `externals` is the set of addresses accessed by CALL-variants, BALANCE, EXTCODE*, and
+    `storage` is the set of (address, key) accessed by SLOAD/SSTORE.
+    """
+
+    def __init__(self, ops, original_address = None):
+        self.ops = ops
+        self.addresses = []
+        self.storageAddresses = []
+        self.frameOf = []
+        self.frames = []
+        self.root = None
+        self.externals = set()
+        self.storage = set()
+        self._build(original_address)
+
+    def _build(self, original_address):
+        addresses = self.addresses
+        storageAddresses = self.storageAddresses
+        frameOf = self.frameOf
+
+        frame = None
+        prev_op = None
+        prev_opnum = None
+        prev_depth = None
+
+        for o in self.ops:
+            if 'depth' not in o:
+                # We're done here
+                break
+            cur_depth = o['depth']
+            opnum = opNumber(o)
+            step = len(addresses)
+
+            # depth may not always start at 1. ganache-cli starts at 0
+            if frame is None:
+                frame = self._newFrame(None, original_address, original_address, cur_depth, step, None)
+                self.root = frame
+
+            elif cur_depth > prev_depth:
+                # Made it into a call-variant
+                # All call-lookalikes are 'gas,address,value' on stack,
+                # so address is second item of prev line
+                #
+                # With a CREATE, we don't know the address until after the RETURN.
+                # After a DELEGATECALL or CALLCODE, the storage is still that of the caller
+                if prev_opnum in (CREATE, CREATE2):
+                    (address, storageAddress) = (None, None)
+                else:
+                    address = prev_op['stack'][-2]
+                    if prev_opnum in (DELEGATECALL, CALLCODE):
+                        storageAddress = frame.storageAddress
+                    else:
+                        storageAddress = address
+                frame = self._newFrame(prev_opnum, address, storageAddress, cur_depth, step, frame)
+
+            elif cur_depth < prev_depth:
+                # Returned from a call
+                while frame.depth > cur_depth and frame.parent is not None:
+                    returned = frame
+                    returned.end = step
+                    frame = frame.parent
+                    if returned.address is None and prev_opnum == RETURN:
+                        # The created address is now on the stack
+                        self._resolve(returned, o['stack'][-1])
+
+            if frame.address is None:
+                frame.placeholders.append(step)
+
+            addresses.append(frame.address)
+            storageAddresses.append(frame.storageAddress)
+            frameOf.append(frame.index)
+
+            if opnum in EXTERNALS:
+                self.externals.add(o['stack'][EXTERNALS[opnum]])
+            elif opnum in (SLOAD, SSTORE) and frame.storageAddress:
+                self.storage.add((frame.storageAddress, o['stack'][-1]))
+
+            prev_op = o
+            prev_opnum = opnum
+            prev_depth = cur_depth
+
+        while frame is not None:
+            frame.end = len(addresses)
+            frame = frame.parent
+
+        self.externals.discard('0x0')
+
+    def _newFrame(self, op, address, storageAddress, depth, start, parent):
+        frame = Frame(op, address, storageAddress, depth, start, parent)
+        frame.index = len(self.frames)
+        self.frames.append(frame)
+        if parent is not None:
+            parent.children.append(frame)
+        return frame
+
+    def _resolve(self, frame, address):
+        frame.address = address
+        for i in frame.placeholders:
+            self.addresses[i] = address
+        frame.placeholders = []
+
+    def frame(self, step):
+        """ Returns the frame which executes the op at `step` """
+        return self.frames[self.frameOf[step]]
+
+    def slotsByAddress(self):
+        """ Returns the accessed storage keys, as a dict of address -> set of keys """
+        slots = {}
+        for (address, key) in self.storage:
+            slots.setdefault(address, set()).add(key)
+        return slots
+
+    def __len__(self):
+        return len(self.addresses)
@@ -2,11 +2,14 @@ import os, shutil
 from web3 import Web3
 from . import etherchain
 from . import multiapi
+from . import rpc
 
-def getApi(url):
+def getApi(url, batch = False):
+    """ If batch is set, account and storage lookups are sent as JSON-RPC batches """
     web3 = Web3(Web3.HTTPProvider(url, request_kwargs={'timeout': 60}))
     chain = etherchain.EtherChainAPI()
-    return multiapi.MultiApi(web3 = web3, etherchain = chain)
+    batchrpc = rpc.BatchRpc(url, timeout = 60) if batch else None
+    return multiapi.MultiApi(web3 = web3, etherchain = chain, rpc = batchrpc)
 
 def checksumAddress(lcAddress):
     return Web3.toChecksumAddress(lcAddress)
@@ -1,4 +1,5 @@
-import os, signal, json, itertools, traceback, sys
+import os, signal, json, itertools, traceback, sys, threading, collections
+import struct, array, hashlib, atexit, tempfile, time, asyncio
 from subprocess import Popen, PIPE, TimeoutExpired
 import platform
 import logging
@@ -72,6 +73,27 @@ def getIntrinsicGas(data):
     
     return tx.intrinsic_gas_used
 """
+def _compare_step(step, names, log):
+    """ Compares one step (one entry per client), and logs it.
+    Returns True if all clients agree"""
+    num_clients = len(names)
+    wrong_clients = []
+    for i in range(1, num_clients):
+        if step[i] != step[0]:
+            wrong_clients.append(i)
+
+    if len(wrong_clients) == 0:
+        log('[*] {:>8} {}'.format("", step[0]))
+        return True
+
+    for i in range(0, num_clients):
+        if i in wrong_clients or len(wrong_clients) == num_clients-1:
+            log('[!!] {:>7} {}'.format(names[i], step[i]))
+        else:
+            log('[*] {:>8} {}'.format(names[i], step[i]))
+    return False
+
+
 def compare_traces(clients_canon_traces, names):
 
     """ Compare 'canonical' traces from the clients"""
@@ -82,36 +104,203 @@ def compare_traces(clients_canon_traces, names):
 
     canon_traces = list(itertools.zip_longest(*clients_canon_traces))
 
-    num_clients = len(names)
     equivalent = True
     for step in canon_traces:
-        wrong_clients = []
-        step_equiv = True
-        for i in range(1, num_clients):
-            if step[i] != step[0]:
-                step_equiv = False
-                wrong_clients.append(i)
-
-        if step_equiv == True:
-            log('[*] {:>8} {}'.format("", step[0]))
-        else:
+        if not _compare_step(step, names, log):
             equivalent = False
-            for i in range(0, num_clients):
-                if i in wrong_clients or len(wrong_clients) == num_clients-1:
-                    log('[!!] {:>7} {}'.format(names[i], step[i]))
-                else:
-                    log('[*] {:>8} {}'.format(names[i], step[i]))
 
     return (equivalent, full_output)
 
 
-def startProc(cmd):
+def compare_traces_stream(clients_canon_steps, names, before = 20, after = 5):
+    """ Compares canonical steps from the clients in lock-step, pulling one step
+    from each client at a time, and stops shortly after the first difference.
+
+    `clients_canon_steps` are iterables of canonical steps, e.g. from `VM.executeStream`.
+    Once done, any generators are closed, which interrupts the clients that are still running.
+
+    Returns (equivalent, output), where the output contains (up to) `before` steps
+    preceding the first difference, and `after` steps following it.
+    """
+    iterators = [iter(steps) for steps in clients_canon_steps]
+    preceding = collections.deque([], before)
+    output = []
+
+    def asText(step):
+        if step is None:
+            return None
+        return toText(step)
+
+    index = 0
+    diff_index = None
+    try:
+        for steps in itertools.zip_longest(*iterators):
+            step = [asText(s) for s in steps]
+            if diff_index is None:
+                lines = []
+                if _compare_step(step, names, lines.append):
+                    preceding.extend(lines)
+                    index = index + 1
+                    continue
+                diff_index = index
+                output.extend(preceding)
+                output.append("\n---- [ %d steps in total before diff ]-------\n" % diff_index)
+                output.extend(lines)
+            else:
+                _compare_step(step, names, output.append)
+            index = index + 1
+            if index - diff_index > after:
+                break
+    finally:
+        for it in iterators:
+            if hasattr(it, 'close'):
+                it.close()
+
+    if diff_index is None:
+        return (True, list(preceding))
+    return (False, output)
+
+
+class CompactTrace(object):
+    """ Compact representation of a canonical trace.
+
+    Each step is a fixed-width record of pc, op, depth, gas and a fingerprint of the
+    stack, packed into one buffer, so that two traces can be compared with a single
+    buffer comparison. The stack items themselves are interned, and only turned back
+    into canonical steps (and text) when needed, e.g. around a divergence.
+    """
+
+    # pc, op, depth, gas, stack fingerprint
+    record = struct.Struct("<IHHQQ")
+
+    # 'op' marker for steps which are not opcodes (stateRoot)
+    NOT_AN_OP = 0xffff
+    MAX_GAS = 0xffffffffffffffff
+
+    def __init__(self):
+        self.records = bytearray()
+        # interned stack items of all steps, concatenated
+        self.stacks = array.array('I')
+        self.stackOffsets = array.array('Q', [0])
+        self.itemIds = {}
+        self.items = []
+        # steps which can't be represented by a record, by index
+        self.raw = {}
+
+    @classmethod
+    def fromSteps(cls, steps):
+        trace = cls()
+        for step in steps:
+            trace.append(step)
+        return trace
+
+    @staticmethod
+    def fingerprint(values):
+        h = hashlib.blake2b("\x00".join(values).encode(), digest_size=8)
+        return int.from_bytes(h.digest(), 'little')
+
+    def _intern(self, item):
+        i = self.itemIds.get(item)
+        if i is None:
+            i = len(self.items)
+            self.itemIds[item] = i
+            self.items.append(item)
+        return i
+
+    def append(self, step):
+        if 'pc' not in step:
+            self.raw[len(self)] = step
+            fp = CompactTrace.fingerprint([json.dumps(step, sort_keys=True)])
+            self.records.extend(CompactTrace.record.pack(0, CompactTrace.NOT_AN_OP, 0, 0, fp))
+            self.stackOffsets.append(len(self.stacks))
+            return
+
+        stack = step['stack']
+        gas = parse_int_or_hex(step['gas'])
+        fp = CompactTrace.fingerprint(stack)
+        if gas > CompactTrace.MAX_GAS:
+            # Keep the actual value around, and let the fingerprint tell them apart
+            self.raw[len(self)] = step
+            fp = CompactTrace.fingerprint(stack + [step['gas']])
+            gas = CompactTrace.MAX_GAS
+        self.records.extend(CompactTrace.record.pack(step['pc'], step['op'], step['depth'], gas, fp))
+        self.stacks.extend([self._intern(item) for item in stack])
+        self.stackOffsets.append(len(self.stacks))
+
+    def __len__(self):
+        return len(self.records) // CompactTrace.record.size
+
+    def step(self, i):
+        """ Materializes step i as a canonical step """
+        if i in self.raw:
+            return dict(self.raw[i])
+        (pc, op, depth, gas, fp) = CompactTrace.record.unpack_from(self.records, i * CompactTrace.record.size)
+        stack = [self.items[x] for x in self.stacks[self.stackOffsets[i]:self.stackOffsets[i+1]]]
+        return {'pc': pc, 'op': op, 'depth': depth, 'gas': '0x{0:01x}'.format(gas), 'stack': stack}
+
+    def text(self, i):
+        if i >= len(self):
+            return None
+        return toText(self.step(i))
+
+    def firstDifference(self, other, chunk = 4096):
+        """ Returns the index of the first step that differs between the traces,
+        or None if they're equal """
+        if self.records == other.records:
+            return None
+        size = CompactTrace.record.size
+        a = memoryview(self.records)
+        b = memoryview(other.records)
+        n = min(len(a), len(b))
+        # Narrow it down chunk by chunk, then step by step
+        offset = 0
+        while offset < n and a[offset:offset + chunk * size] == b[offset:offset + chunk * size]:
+            offset = offset + chunk * size
+        while offset < n and a[offset:offset + size] == b[offset:offset + size]:
+            offset = offset + size
+        return offset // size
+
+
+def compare_compact_traces(traces, names, before = 20, after = 5):
+    """ Compares CompactTraces from the clients. Only the fingerprints are compared,
+    text is materialized for the steps around the first difference.
+
+    Returns (equivalent, output), where the output has the same format as compare_traces,
+    and contains (up to) `before` steps before the first difference and `after` steps
+    following it. Use None to get everything before or after. Only if steps before the
+    difference are left out, the output marks the number of steps before it (as
+    compare_traces_stream does); otherwise that's left to e.g. a summary of the output.
+    """
+    diffs = [t.firstDifference(traces[0]) for t in traces[1:]]
+    diffs = [d for d in diffs if d is not None]
+    if len(diffs) == 0:
+        return (True, [])
+
+    diff_index = min(diffs)
+    longest = max(len(t) for t in traces)
+    start = 0 if before is None else max(0, diff_index - before)
+    end = longest if after is None else min(longest, diff_index + after + 1)
+
+    output = []
+    for i in range(start, end):
+        if i == diff_index and before is not None:
+            output.append("\n---- [ %d steps in total before diff ]-------\n" % diff_index)
+        _compare_step([t.text(i) for t in traces], names, output.append)
+
+    return (False, output)
+
+
+def startProc(cmd, output=None):
     # passing a list to Popen doesn't work. Can't read stdout from docker container when shell=False
     #pyeth_process = subprocess.Popen(pyeth_docker_cmd, shell=False, stdout=subprocess.PIPE, close_fds=True)
 
     # need to pass a string to Popen and shell=True to get stdout from docker container
     print(" ".join(cmd))
-    return Popen(" ".join(cmd), stdout=PIPE,shell=True, stderr=PIPE, preexec_fn=os.setsid)
+    # When the output is going to be streamed, only that pipe is opened: an
+    # unread second pipe would fill up and block the client
+    stdout = FNULL if output == 'stderr' else PIPE
+    stderr = FNULL if output == 'stdout' else PIPE
+    return Popen(" ".join(cmd), stdout=stdout,shell=True, stderr=stderr, preexec_fn=os.setsid)
 
 
 def finishProc(process, extraTime=False, output="stdout", timeout = 30):
@@ -122,200 +311,623 @@ def finishProc(process, extraTime=False, output="stdout", timeout = 30):
         (stdoutdata, stderrdata) = process.communicate(timeout=timeout)
     except TimeoutExpired:
         logger.info("TIMEOUT ERROR!")
-        os.killpg(process.pid, signal.SIGINT) # send signal to the process group
+        killProc(process) # send signal to the process group
         (stdoutdata, stderrdata) = process.communicate()
+    releaseProc(process)
 
     if output == 'stdout':
         return stdoutdata.decode().strip().split("\n")
     return stderrdata.decode().strip().split("\n")
 
-class VM(object):
 
-    def __init__(self,executable="evmbin", docker = False):
-        self.executable = executable
-        self.docker = docker
-        self.genesis_format = "parity"
-        self.lastCommand = ""
+def killProc(process):
+    """ Interrupts the process group of a running client, if still alive """
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGINT)
+            process.interrupted = True
+        except ProcessLookupError:
+            pass
+
+
+def releaseProc(process):
+    """ Returns the pooled container a client ran in (if any) to its pool, once the client
+    has finished. The container is restarted if the client was interrupted: that only stops
+    the local `docker exec`, not the client process within the container. """
+    lease = getattr(process, 'lease', None)
+    if lease is not None:
+        process.lease = None
+        (pool, name) = lease
+        pool.release(name, aborted = getattr(process, 'interrupted', False))
+
+
+def iterProc(process, output="stdout", timeout = None):
+    """ Yields the output lines of a running process as they are produced,
+    instead of waiting for the process to finish like finishProc does.
+
+    If the consumer stops early (closes the generator), or the timeout expires,
+    the process group is interrupted.
+    """
+    stream = process.stdout if output == 'stdout' else process.stderr
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, killProc, (process,))
+        timer.daemon = True
+        timer.start()
+    completed = False
+    try:
+        for line in stream:
+            yield line.decode().rstrip("\r\n")
+        completed = True
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if completed:
+            # The client closed its output: reap it, it may not have exited yet
+            process.wait()
+        else:
+            killProc(process)
+        stream.close()
+        process.wait()
+        releaseProc(process)
 
-    def _run(self,cmd):
-        self.lastCommand = " ".join(cmd)
-        return finishProc(startProc(cmd))
 
-    def _start(self, cmd):
-        self.lastCommand = " ".join(cmd)
-        return startProc(cmd)
+def dockerMount(path):
+    """ Returns the docker volume argument to mount the directory `path` at the same location """
+    if platform.system() == 'Darwin':
+        return '%s:%s' % (os.path.join('/private', path.strip('/')), path)
+    return '%s:%s' % (path, path)
 
-class JsVM(VM):
-    @staticmethod
-    def canonicalized(output):
-        steps = []
-        for index, line in enumerate(output):
-            if line and line.startswith('# {'):
-                result = json.loads(line.strip('# '))
-                steps.append(result)
-        return steps
 
+# Max length of an output line read by the asyncio api. Lines with memory can be large
+ASYNC_LINE_LIMIT = 2**27
 
-class HeraVM(VM):
-    @staticmethod
-    def canonicalized(output):
-        from . import opcodes
-        valid_opcodes = opcodes.reverse_opcodes.keys()
+def killAsyncProc(process):
+    """ Interrupts the process group of a running asyncio client, if still alive """
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGINT)
+            process.interrupted = True
+        except ProcessLookupError:
+            pass
+
+
+class ContainerPool(object):
+    """ A pool of long-lived containers of one image. Executions are performed with
+    `docker exec` in one of the containers, instead of starting a new container
+    with `docker run --rm` for every execution.
+
+    Containers are started on first use, and (at most every `checkInterval` seconds)
+    checked before use, and restarted if they're no longer running.
+
+    A container is used by one execution at a time (see acquire/release), so that the
+    container of an interrupted execution can be restarted without affecting others.
+    """
+
+    def __init__(self, image, binary, size = 1, mounts = None, checkInterval = 30):
+        self.image = image
+        # the executable within the container
+        self.binary = binary
+        self.size = size
+        # genesis files are created in the temp dir
+        self.mounts = mounts or [tempfile.gettempdir()]
+        self.checkInterval = checkInterval
+        self.containers = []
+        # containers not in use by an execution
+        self.idle = []
+        self.lastChecked = {}
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _name(self, i):
+        return "evmlab-%s-%d-%d" % (re.sub(r'[^a-zA-Z0-9_.-]', '_', self.image), os.getpid(), i)
+
+    def _startContainer(self, name):
+        cmd = ['docker', 'run', '-d', '--rm', '--name', name, '--entrypoint', 'sleep']
+        for mount in self.mounts:
+            cmd.extend(['-v', dockerMount(mount)])
+        cmd.extend([self.image, '356d'])
+        finishProc(startProc(cmd))
+        self.lastChecked[name] = time.time()
+        logger.info("Started pooled container %s (%s)" % (name, self.image))
+
+    def _killContainer(self, name):
+        # rm -f rather than kill, so that the name can be reused right away
+        finishProc(startProc(['docker', 'rm', '-f', name]))
+
+    def _isRunning(self, name):
+        return finishProc(startProc(['docker', 'inspect', '-f', '{{.State.Running}}', name])) == ['true']
+
+    def covers(self, path):
+        """ Returns True if the file at `path` is visible within the containers """
+        if path is None:
+            return True
+        path = os.path.abspath(path)
+        return any(path.startswith(os.path.join(os.path.abspath(m), '')) for m in self.mounts)
+
+    def acquire(self):
+        """ Returns the name of a (healthy) container to execute in, reserved until it's
+        released, or None if all containers are in use """
+        with self.lock:
+            if not self.containers:
+                self.containers = [self._name(i) for i in range(self.size)]
+                for name in self.containers:
+                    self._startContainer(name)
+                self.idle = list(self.containers)
+
+            if not self.idle:
+                return None
+            name = self.idle.pop()
+
+            now = time.time()
+            if now - self.lastChecked.get(name, 0) > self.checkInterval:
+                if not self._isRunning(name):
+                    logger.warning("Pooled container %s is not running, restarting it" % name)
+                    self._killContainer(name)
+                    self._startContainer(name)
+                self.lastChecked[name] = now
+        return name
+
+    def release(self, name, aborted = False):
+        """ Makes the container available again. If the execution in it was aborted, the
+        container is restarted to stop the client still running within it """
+        if aborted:
+            logger.info("Restarting pooled container %s after an aborted execution" % name)
+            self._killContainer(name)
+            self._startContainer(name)
+        with self.lock:
+            if name in self.containers:
+                self.idle.append(name)
+
+    def close(self):
+        with self.lock:
+            for name in self.containers:
+                self._killContainer(name)
+            self.containers = []
+            self.idle = []
+
+
+class Canonicalizer(object):
+    """ Incrementally converts the output of a client into 'canonical' steps.
+
+    Lines are fed one at a time, and each call returns the (possibly empty)
+    list of canonical steps that line resulted in, so that a trace never has to
+    be held in memory as a whole.
+    """
+
+    def __init__(self):
+        # number of canonical steps emitted so far
+        self.count = 0
+
+    def feed(self, line):
+        return []
+
+    def finish(self):
+        return []
+
+    def _emit(self, step):
+        self.count = self.count + 1
+        return [step]
+
+
+class JsCanonicalizer(Canonicalizer):
+
+    def feed(self, line):
+        if line and line.startswith('# {'):
+            return self._emit(json.loads(line.strip('# ')))
+        return []
+
+
+class HeraCanonicalizer(Canonicalizer):
+
+    def feed(self, x):
+        try:
+            if len(x) > 0  and x[0] == "{":
+                step = json.loads(x)
+                if 'stateRoot' in step.keys() and INCLUDE_STATEROOT:
+                  return self._emit(step)
+                else:
+                  step['gas'] = hex(step['gas'])
+                  step['stack'] = step['stack'][::-1]
+                  for i in range(0, len(step['stack'])):
+                      step['stack'][i] = re.sub(r'0x0+([0-9a-f]+)$', '0x\g<1>', step['stack'][i])
 
-        steps = []
-        for x in output:
-            try:
-                if len(x) > 0  and x[0] == "{":
-                    step = json.loads(x)
-                    if 'stateRoot' in step.keys() and INCLUDE_STATEROOT:
-                      steps.append(step)
-                    else:
-                      step['gas'] = hex(step['gas'])
-                      step['stack'] = step['stack'][::-1]
-                      for i in range(0, len(step['stack'])):
-                          step['stack'][i] = re.sub(r'0x0+([0-9a-f]+)$', '0x\g<1>', step['stack'][i])
+                  return self._emit(step)
 
-                      steps.append(step)
+        except Exception as e:
+            logger.info('Exception parsing Hera json:')
+            logger.info(e)
+            logger.info('problematic line:')
+            logger.info(x[:500])
+        return []
 
-            except Exception as e:
-                logger.info('Exception parsing Hera json:')
-                logger.info(e)
-                logger.info('problematic line:')
-                logger.info(x[:500])
 
-        return steps
+class CppCanonicalizer(Canonicalizer):
 
+    def __init__(self):
+        super().__init__()
+        self.last = None
 
-class CppVM(VM):
+    def feed(self, x):
+        steps = []
+        try:
+            if x[0:2] == "[{":
+                    steps = json.loads(x)
 
-    @staticmethod
-    def canonicalized(output):
-        from . import opcodes
-        valid_opcodes = opcodes.reverse_opcodes.keys()
+            if x[0:2] == "{\"":
+                # A bug in testeth
+                if x[-1] == '.':
+                    x = x[:-1]
 
-        steps = []
-        for x in output:
-            try:
-                if x[0:2] == "[{":
-                        steps = json.loads(x)
-
-                if x[0:2] == "{\"":
-                    # A bug in testeth
-                    if x[-1] == '.':
-                        x = x[:-1]
-
-                    step = json.loads(x)
-                    if 'stateRoot' in step.keys() and INCLUDE_STATEROOT:
-                        steps.append(step)
-
-            except Exception as e:
-                logger.info('Exception parsing cpp json:')
-                logger.info(e)
-                logger.info('problematic line:')
-                logger.info(x[:500])
+                step = json.loads(x)
+                if 'stateRoot' in step.keys() and INCLUDE_STATEROOT:
+                    steps = [step]
 
-        canon_steps = []
+        except Exception as e:
+            logger.info('Exception parsing cpp json:')
+            logger.info(e)
+            logger.info('problematic line:')
+            logger.info(x[:500])
 
+        canon_steps = []
         try:
             for step in steps:
-                if 'stateRoot' in step.keys():
-                    if len(canon_steps): # dont log state root if no previous EVM steps
-                        canon_steps.append(step) # should happen last
-                    continue
-                if step['op'] in ['INVALID', 'STOP'] :
-                    # skip STOPs
-                    continue
-                if step['op'] not in valid_opcodes:
-                    logger.info("got cpp step for an unknown opcode:")
-                    logger.info(step)
-                    continue
-
-                trace_step = {
-                    'pc'  : step['pc'],
-                    'gas': '0x{0:01x}'.format(int(step['gas'])) ,
-                    'op': opcodes.reverse_opcodes[step['op']],
-                    'depth' : step['depth'],
-                    'stack' : toHexQuantities(step['stack']),
-                }
-                canon_steps.append(trace_step)
+                canon_steps.extend(self._canon(step))
+        except Exception as e:
+            logger.info('Exception parsing cpp step:')
+            logger.info(e)
 
-                # Sometimes, the last one is duplicated. let's just remove that, if so
+        return canon_steps
 
-                if len(canon_steps) > 1:
-                    last = canon_steps[-1]
-                    slast = canon_steps[-2]
-                    if slast['depth'] == last['depth'] and slast['pc'] == last['pc']:
-                        canon_steps = canon_steps[:-1]
+    def _canon(self, step):
+        if 'stateRoot' in step.keys():
+            if self.count: # dont log state root if no previous EVM steps
+                return self._emit(step) # should happen last
+            return []
+        if step['op'] in ['INVALID', 'STOP'] :
+            # skip STOPs
+            return []
+        if step['op'] not in valid_opcodes:
+            logger.info("got cpp step for an unknown opcode:")
+            logger.info(step)
+            return []
+
+        trace_step = {
+            'pc'  : step['pc'],
+            'gas': '0x{0:01x}'.format(int(step['gas'])) ,
+            'op': opcodes.reverse_opcodes[step['op']],
+            'depth' : step['depth'],
+            'stack' : toHexQuantities(step['stack']),
+        }
+
+        # Sometimes, the last one is duplicated. let's just remove that, if so
+        last = self.last
+        if last is not None and last['depth'] == trace_step['depth'] and last['pc'] == trace_step['pc']:
+            return []
+
+        self.last = trace_step
+        return self._emit(trace_step)
+
+
+class PyCanonicalizer(Canonicalizer):
 
+    @staticmethod
+    def formatStackItem(el):
+        return '0x{0:01x}'.format(int(el.replace("b", "").replace("'", "")))
+
+    def feed(self, line):
+        if line.startswith("tx:"):
+            return []
+        if line.startswith("tx_decoded:"):
+            return []
+        json_index = line.find("{")
+        if json_index < 0:
+            return []
+        try:
+            step = json.loads(line[json_index:])
         except Exception as e:
-            logger.info('Exception parsing cpp step:')
+            logger.info("Exception parsing python output:")
             logger.info(e)
+            logger.info("problematic line:")
+            logger.info(line)
+            return []
+
+        if 'stateRoot' in step.keys():
+            # dont log stateRoot when tx doesnt execute, to match cpp and parity
+            if self.count and INCLUDE_STATEROOT:
+                return self._emit(step)
+            return []
+        if 'event' not in step.keys():
+            return []
+        if step['event'] == 'eth.vm.op.vm':
+            if step['op'] not in valid_opcodes:
+                # invalid opcode
+                return []
+            if step['op'] == 'STOP':
+                # geth logs code-out-of-range as a STOP, and we 
+                # can't distinguish them from actual STOPs (that pyeth logs)
+                return []
+
+            trace_step = {
+                'opName' : step['op'],
+                'op'     : step['inst'],
+                'depth'  : step['depth'],
+                'pc'     : bstrToInt(step['pc']),
+                'gas'    : bstrToHex(step['gas']),
+            }
+
+            trace_step['stack'] = [PyCanonicalizer.formatStackItem(el) for el in step['stack']]
+            return self._emit(trace_step)
+        return []
+
+
+class GethCanonicalizer(Canonicalizer):
+
+    name = "geth"
+
+    def feed(self, line):
+        if len(line) == 0 or line[0] != "{":
+            return []
+        try:
+            step = json.loads(line)
+        except Exception as e:
+            logger.warn('Exception [1] parsing %s output:' % self.name)
+            traceback.print_exc(file=sys.stdout)
+            logger.warn(e)
+            return []
 
-        return canon_steps
+        try:
+            return self._canon(step)
+        except Exception as e:
+            logger.warn('Exception [2] parsing %s output:' % self.name)
+            traceback.print_exc(file=sys.stdout)
+            logger.warn(e)
+        return []
+
+    def _canon(self, step):
+        if 'stateRoot' in step.keys() :
+            # don't log stateRoot when tx doesnt execute, to match cpp and parity
+            # should be last step
+            if self.count and INCLUDE_STATEROOT:
+                return self._emit(step)
+            return []
+
+        # Ignored for now
+        # The last one is {"output":"","gasUsed":"0x34a48","time":4787059}
+        if 'error' in step.keys() and 'output' in step.keys():
+            return []
+        if 'time' in step.keys() or 'output' in step.keys():
+            return []
+
+        if not 'op' in step.keys():
+            logger.warn("Missing 'op': %s" % str(step))
+            return []
+
+        if step['op'] == 0:
+            # skip STOPs
+            return []
+        if step['opName'] == "" or step['op'] not in opcodes.opcodes:
+            # invalid opcode
+            return []
+        trace_step = {
+            'pc'  : step['pc'],
+            'gas': step['gas'],
+            'op': step['op'],
+            # we want a 0-based depth
+            'depth' : step['depth'] -1,
+            'stack' : step['stack'],
+        }
+        return self._emit(trace_step)
+
+
+class ParityCanonicalizer(GethCanonicalizer):
+
+    name = "parity"
+
+    def _canon(self, p_step):
+        if 'test' in p_step.keys():
+            # first step of trace has test name
+            return []
+
+        if 'stateRoot' in p_step.keys():
+            # dont log the stateRoot for basic tx's (that have no EVM steps)
+            # should be last step
+            if self.count and INCLUDE_STATEROOT:
+                return self._emit(p_step)
+            return []
+
+        # Ignored for now
+        if 'error' in p_step.keys() or 'output' in p_step.keys():
+            return []
+
+        if not 'op' in p_step.keys():
+            logger.warn("Missing 'op': %s" % str(p_step))
+            return []
+
+        if p_step['op'] == 0:
+            # skip STOPs
+            return []
+        if p_step['opName'] == "" or p_step['op'] not in opcodes.opcodes:
+            # invalid opcode
+            return []
+        trace_step = {
+            'pc'  : p_step['pc'],
+            'gas': p_step['gas'],
+            'op': p_step['op'],
+            # parity depth starts at 1, but we want a 0-based depth
+            'depth' : p_step['depth'] -1,
+            'stack' : p_step['stack'],
+        }
+        return self._emit(trace_step)
 
-class PyVM(VM):
+
+class VM(object):
+
+    canonicalizer = Canonicalizer
+    # the executable within the docker image, used for pooled execution
+    dockerBinary = "evm"
+
+    def __init__(self,executable="evmbin", docker = False, poolsize = 0):
+        self.executable = executable
+        self.docker = docker
+        self.genesis_format = "parity"
+        self.lastCommand = ""
+        self.pool = None
+        if docker and poolsize > 0:
+            self.pool = ContainerPool(executable, self.dockerBinary, poolsize)
+
+    def _container(self, kwargs):
+        """ Returns a pooled container to execute in, if pooling is enabled
+        and the referenced files are available inside the containers """
+        if self.pool is None or not self.pool.covers(kwargs.get('genesis')):
+            return None
+        return self.pool.acquire()
+
+    def _lease(self, process, container):
+        """ Ties the pooled container to the process, to be released with releaseProc """
+        process.lease = (self.pool, container) if container is not None else None
+        return process
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+    def _run(self,cmd):
+        self.lastCommand = " ".join(cmd)
+        return finishProc(startProc(cmd))
+
+    def _start(self, cmd, output=None):
+        self.lastCommand = " ".join(cmd)
+        return startProc(cmd, output)
+
+    def start(self, output=None, **kwargs):
+        """ Starts the client. The process must be finished with finishProc or iterProc (or
+        passed to releaseProc), to return a pooled container """
+        container = self._container(kwargs)
+        try:
+            process = self._start(self.makeCommand(container=container, **kwargs), output)
+        except:
+            if container is not None:
+                self.pool.release(container)
+            raise
+        return self._lease(process, container)
+
+    def execute(self, **kwargs):
+        return finishProc(self.start(**kwargs))
+
+    def executeStream(self, timeout = 30, **kwargs):
+        """ Executes and yields the canonical steps while the client is still running.
+        The client is started on the first step requested; closing the generator
+        interrupts the client """
+        process = self.start(output="stdout", **kwargs)
+        yield from self.canonicalizedStream(iterProc(process, "stdout", timeout))
+
+    async def _startAsync(self, kwargs, output=None):
+        loop = asyncio.get_running_loop()
+        # acquiring may start a container, or wait for one to be released
+        container = await loop.run_in_executor(None, self._container, kwargs)
+        stdout = asyncio.subprocess.DEVNULL if output == 'stderr' else asyncio.subprocess.PIPE
+        stderr = asyncio.subprocess.DEVNULL if output == 'stdout' else asyncio.subprocess.PIPE
+        try:
+            cmd = self.makeCommand(container=container, **kwargs)
+            self.lastCommand = " ".join(cmd)
+            print(self.lastCommand)
+            # Run through the shell like startProc, so both paths run the same command line
+            process = await asyncio.create_subprocess_shell(self.lastCommand, stdout=stdout, stderr=stderr,
+                                                            start_new_session=True, limit=ASYNC_LINE_LIMIT)
+        except:
+            if container is not None:
+                await loop.run_in_executor(None, self.pool.release, container)
+            raise
+        return self._lease(process, container)
 
     @staticmethod
-    def canonicalized(output):
-        from . import opcodes
+    async def _releaseAsync(process):
+        # releasing may restart a container, which blocks
+        await asyncio.get_running_loop().run_in_executor(None, releaseProc, process)
+
+    async def executeAsync(self, timeout = 30, output = "stdout", **kwargs):
+        """ asyncio counterpart of `execute`, returns the output lines """
+        process = await self._startAsync(kwargs)
+        # Not cancelled on timeout, so the output produced so far is kept
+        communicate = asyncio.ensure_future(process.communicate())
+        (done, pending) = await asyncio.wait([communicate], timeout=timeout)
+        if not done:
+            logger.info("TIMEOUT ERROR!")
+            killAsyncProc(process)
+        (stdoutdata, stderrdata) = await communicate
+        await self._releaseAsync(process)
+
+        if output == 'stdout':
+            return stdoutdata.decode().strip().split("\n")
+        return stderrdata.decode().strip().split("\n")
+
+    async def executeStreamAsync(self, timeout = 30, **kwargs):
+        """ asyncio counterpart of `executeStream`: an async iterator of the canonical steps,
+        produced while the client is running. The client is interrupted when the timeout
+        expires, or the iterator is closed early """
+        process = await self._startAsync(kwargs, "stdout")
+        canonicalizer = self.canonicalizer()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        completed = False
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    logger.info("TIMEOUT ERROR!")
+                    break
+                if not line:
+                    completed = True
+                    break
+                for step in canonicalizer.feed(line.decode().rstrip("\r\n")):
+                    yield step
+            for step in canonicalizer.finish():
+                yield step
+        finally:
+            # After the end of the output, the client is only waited for: it may not
+            # have been reaped yet, and interrupting it would restart its container
+            if not completed:
+                killAsyncProc(process)
+            await process.wait()
+            await self._releaseAsync(process)
+
+    @classmethod
+    def canonicalizedStream(cls, output):
+        """ Yields the canonical steps of an iterable of output lines """
+        canonicalizer = cls.canonicalizer()
+        for line in output:
+            yield from canonicalizer.feed(line)
+        yield from canonicalizer.finish()
 
-        def formatStackItem(el):
-            return '0x{0:01x}'.format(int(el.replace("b", "").replace("'", "")))
+    @classmethod
+    def canonicalized(cls, output):
+        return list(cls.canonicalizedStream(output))
 
-        def json_steps():
-            for line in output:
-                if line.startswith("tx:"):
-                    continue
-                if line.startswith("tx_decoded:"):
-                    continue
-                json_index = line.find("{")
-                if json_index >= 0:
-                    try:
-                        yield(json.loads(line[json_index:]))
-                    except Exception as e:
-                        logger.info("Exception parsing python output:")
-                        logger.info(e)
-                        logger.info("problematic line:")
-                        logger.info(line)
-                        yield({})
 
-        canon_steps = []
-        for step in json_steps():
-            #print (step)
-            if 'stateRoot' in step.keys():
-                # dont log stateRoot when tx doesnt execute, to match cpp and parity
-                if len(canon_steps) and INCLUDE_STATEROOT:
-                    canon_steps.append(step)
-                continue
-            if 'event' not in step.keys():               
-                continue
-            if step['event'] == 'eth.vm.op.vm':
-                if step['op'] not in valid_opcodes:
-                    # invalid opcode
-                    continue
-                if step['op'] == 'STOP':
-                    # geth logs code-out-of-range as a STOP, and we 
-                    # can't distinguish them from actual STOPs (that pyeth logs)
-                    continue
+class JsVM(VM):
+    canonicalizer = JsCanonicalizer
+
 
-                trace_step = {
-                    'opName' : step['op'],
-                    'op'     : step['inst'],
-                    'depth'  : step['depth'],
-                    'pc'     : bstrToInt(step['pc']),
-                    'gas'    : bstrToHex(step['gas']),
-                }
+class HeraVM(VM):
+    canonicalizer = HeraCanonicalizer
 
-                trace_step['stack'] = [formatStackItem(el) for el in step['stack']]
-                canon_steps.append(trace_step)
 
-        return canon_steps
+class CppVM(VM):
+    canonicalizer = CppCanonicalizer
+
+
+class PyVM(VM):
+    canonicalizer = PyCanonicalizer
 
 
 class GethVM(VM):
 
-    def __init__(self,executable="evmbin", docker = False):
-        super().__init__( executable, docker)
+    canonicalizer = GethCanonicalizer
+
+    def __init__(self,executable="evmbin", docker = False, poolsize = 0):
+        super().__init__( executable, docker, poolsize)
         self.genesis_format="geth"
 
     def makeCommand(self, **kwargs):
@@ -333,18 +945,18 @@ class GethVM(VM):
             if get(v, default=default):
                 cmd.extend(["--%s" % flagname, str(get(v,default=default))])
 
-        if self.docker: 
+        if self.docker and get('container'):
+            # Execute in a pooled container
+            cmd.extend(['docker', 'exec', get('container'), self.dockerBinary])
+        elif self.docker: 
             cmd.extend(['docker', 'run', '--rm'])
             # If any files are referenced, they need to be mounted
             if get('genesis') is not None:
-                genesis_mount = os.path.dirname(get('genesis'))
                 cmd.append('-v')
-                if platform.system() == 'Darwin':
-                    cmd.append('%s:%s' % (os.path.join('/private', genesis_mount.strip('/')), genesis_mount))
-                else:
-                    cmd.append('%s:%s' % (genesis_mount, genesis_mount))
-
-        cmd.append( self.executable ) 
+                cmd.append(dockerMount(os.path.dirname(get('genesis'))))
+            cmd.append( self.executable ) 
+        else:
+            cmd.append( self.executable ) 
 
         if get('receiver') == "":
             kwargs.pop("receiver", None)
@@ -373,83 +985,14 @@ class GethVM(VM):
 
         return cmd
 
-    def start(self, **kwargs):
-        return self._start(self.makeCommand(**kwargs))
-
-    def execute(self, **kwargs):
-        return finishProc(self.start(**kwargs))
-
-    @staticmethod
-    def canonicalized(output):
-        from . import opcodes
-        parsed_steps = []
-        for line in output:
-            if len(line) > 0 and line[0] == "{":
-                try:
-                    parsed_steps.append(json.loads(line))
-                except Exception as e:
-                    logger.warn('Exception [1] parsing geth output:')
-                    traceback.print_exc(file=sys.stdout)
-                    logger.warn(e)
-
-        canon_steps = []
-        if len(parsed_steps) == 0:
-            return canon_steps
-            
-        try:
-            if 'output' in parsed_steps[-1]:
-                # last one is {"output":"","gasUsed":"0x34a48","time":4787059}
-                # Remove    
-                parsed_steps = parsed_steps[:-1]
-
-            for step in parsed_steps:
-                if 'stateRoot' in step.keys() :
-                    # don't log stateRoot when tx doesnt execute, to match cpp and parity
-                    # should be last step
-                    if len(canon_steps) and INCLUDE_STATEROOT:
-                        canon_steps.append(step)
-                    
-                    continue
-
-
-                # Ignored for now
-                if 'error' in step.keys() and 'output' in step.keys():
-                    continue
-                if 'time' in step.keys():
-                    continue
-
-                if not 'op' in step.keys():
-                    logger.warn("Missing 'op': %s" % str(step))
-                    continue
-
-                if step['op'] == 0:
-                    # skip STOPs
-                    continue
-                if step['opName'] == "" or step['op'] not in opcodes.opcodes:
-                    # invalid opcode
-                    continue
-                trace_step = {
-                    'pc'  : step['pc'],
-                    'gas': step['gas'],
-                    'op': step['op'],
-                    # we want a 0-based depth
-                    'depth' : step['depth'] -1,
-                    'stack' : step['stack'],
-                }
-                canon_steps.append(trace_step)
-        except Exception as e:
-            logger.warn('Exception [2] parsing geth output:')
-            traceback.print_exc(file=sys.stdout)
-            logger.warn(e)
-
-        return canon_steps
-
-
 
 class ParityVM(VM):
 
-    def __init__(self,executable="evmbin", docker = False):
-        super().__init__(executable, docker)
+    canonicalizer = ParityCanonicalizer
+    dockerBinary = "/parity-evm"
+
+    def __init__(self,executable="evmbin", docker = False, poolsize = 0):
+        super().__init__(executable, docker, poolsize)
     
     def makeCommand(self, **kwargs):
         
@@ -469,19 +1012,18 @@ class ParityVM(VM):
         input = get('input')
         _json = get('json')
         
-        if self.docker: 
+        if self.docker and get('container'):
+            # Execute in a pooled container
+            cmd = ['docker', 'exec', get('container'), self.dockerBinary]
+        elif self.docker: 
             cmd = ['docker', 'run','--rm']
             # If any files are referenced, they need to be mounted
             if get('genesis') is not None:
-                genesis_mount = os.path.dirname(get('genesis'))
                 cmd.append('-v')
-                if platform.system() == 'Darwin':
-                    cmd.append('%s:%s' % (os.path.join('/private', genesis_mount.strip('/')), genesis_mount))
-                else:
-                    cmd.append('%s:%s' % (genesis_mount, genesis_mount))
+                cmd.append(dockerMount(os.path.dirname(get('genesis'))))
 
             cmd.append( self.executable )
-            cmd.append("/parity-evm")
+            cmd.append(self.dockerBinary)
         else:
             cmd = [self.executable]
 
@@ -507,68 +1049,3 @@ class ParityVM(VM):
             cmd.append("--json")
 
         return cmd
-
-    def start(self, **kwargs):
-        return self._start(self.makeCommand(**kwargs))
-
-
-    def execute(self, **kwargs):
-        return finishProc(self.start(**kwargs))
-
-    @staticmethod
-    def canonicalized(output):
-        from . import opcodes
-        parsed_steps = []
-        for line in output:
-            if len(line) > 0 and line[0] == "{":
-                try:
-                    parsed_steps.append(json.loads(line))
-                except Exception as e:
-                    logger.warn('Exception [1] parsing parity output:')
-                    logger.warn(e)
-
-        canon_steps = []
-        try:
-            for p_step in parsed_steps:
-                if 'test' in p_step.keys():
-                    # first step of trace has test name
-                    continue
-
-                if 'stateRoot' in p_step.keys():
-                    # dont log the stateRoot for basic tx's (that have no EVM steps)
-                    # should be last step
-                    if len(canon_steps) and INCLUDE_STATEROOT:
-                        canon_steps.append(step)
-                    continue
-
-                # Ignored for now
-                if 'error' in p_step.keys() or 'output' in p_step.keys():
-                    continue
-
-                if not 'op' in p_step.keys():
-                    logger.warn("Missing 'op': %s" % str(p_step))
-                    continue
-                    
-                if p_step['op'] == 0:
-                    # skip STOPs
-                    continue
-                if p_step['opName'] == "" or p_step['op'] not in opcodes.opcodes:
-                    # invalid opcode
-                    continue
-                trace_step = {
-                    'pc'  : p_step['pc'],
-                    'gas': p_step['gas'],
-                    'op': p_step['op'],
-                    # parity depth starts at 1, but we want a 0-based depth
-                    'depth' : p_step['depth'] -1,
-                    'stack' : p_step['stack'],
-                }
-                canon_steps.append(trace_step)
-        except Exception as e:
-            logger.warn('Exception [2] parsing parity output:')
-            logger.warn(e)
-
-        return canon_steps
-
-
-
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks the pc -> source mapping lookups of Contract, as done by buildContexts for
+each op of a trace, on a synthetic trace against a large (24KB) contract. The previous
+lookup (a linear search of the list of pcs) is timed on a sample and extrapolated.
+
+Usage:
+    python3 bench_contract.py [steps]
+"""
+import sys, time, random
+
+from evmlab.contract import Contract
+
+
+def makeContract(size = 24 * 1024, seed = 1):
+    """ Returns the contract json of random code of `size` bytes, with a source map """
+    rnd = random.Random(seed)
+    code = bytearray()
+    n = 0
+    while len(code) < size:
+        op = rnd.choice([0x01, 0x50, 0x54, 0x56, 0x57, 0x5b, 0x60, 0x61, 0x63, 0x73, 0x7f, 0x80, 0x90])
+        code.append(op)
+        if 0x60 <= op <= 0x7f:
+            code.extend(bytes(op - 0x5f))
+        n = n + 1
+    source = "contract Big {\n" + "".join("    uint x%d;\n" % i for i in range(1000)) + "}\n"
+    # the source is file 1, file 0 is an empty placeholder
+    srcmap = ";".join("%d:%d:1:-" % (rnd.randrange(0, len(source) - 10), 10) for _ in range(n))
+    return (source, {'bin-runtime': code.hex(), 'srcmap-runtime': srcmap, 'bin': "", 'srcmap': ""})
+
+def oldMappingIndex(ins, pc):
+    pcs = list(ins.keys())
+    if pc in pcs:
+        return pcs.index(pc)
+    raise KeyError
+
+def main(args):
+    steps = int(args[0]) if len(args) > 0 else 1000000
+    (source, json) = makeContract()
+    t = time.time()
+    contract = Contract(["", source], json, "Big")
+    print("Contract: %d bytes, %d instructions, loaded in %.3fs" % (
+        len(json['bin-runtime']) // 2, len(contract.insRuntime), time.time() - t))
+
+    rnd = random.Random(2)
+    pcs = list(contract.insRuntime.keys())
+    trace = [rnd.choice(pcs) for _ in range(steps)]
+
+    sample = trace[:1000]
+    t = time.time()
+    for pc in sample:
+        oldMappingIndex(contract.insRuntime, pc)
+    old = (time.time() - t) * steps / len(sample)
+    print("list index lookup:   %.1fs for %d steps (extrapolated from %d)" % (old, steps, len(sample)))
+
+    t = time.time()
+    for pc in trace:
+        contract._getMappingIndex(pc)
+    print("dense array lookup:  %.3fs for %d steps" % (time.time() - t, steps))
+
+    t = time.time()
+    for pc in trace:
+        contract.getSourceCode(pc)
+    print("getSourceCode:       %.3fs for %d steps" % (time.time() - t, steps))
+
+    assert all(oldMappingIndex(contract.insRuntime, pc) == contract._getMappingIndex(pc) for pc in sample)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
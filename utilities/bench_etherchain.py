@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks fetching a transaction history and balances from the etherchain api,
+against the stub in rpc_stub.py, with one request at a time versus several in flight.
+
+Usage:
+    python3 bench_etherchain.py [transactions] [addresses] [latency in ms]
+"""
+import sys, time, tempfile, io
+from contextlib import redirect_stdout
+
+from evmlab import etherchain
+
+import rpc_stub
+
+
+def main(args):
+    history = int(args[0]) if len(args) > 0 else 2000
+    naddresses = int(args[1]) if len(args) > 1 else 100
+    latency = float(args[2]) / 1000 if len(args) > 2 else 0.02
+    (server, url) = rpc_stub.serve(latency = latency, history = history)
+
+    address = "0x%040x" % 0xabc
+    addresses = ["0x%040x" % i for i in range(naddresses)]
+    print("%d transactions, %d balances, %.1f ms latency per request" % (history, naddresses, latency * 1000))
+
+    for workers in [1, 8]:
+        api = etherchain.EtherChainAPI(baseurl = url, workers = workers, rate = 0,
+                                       datastore = tempfile.mkdtemp(prefix="evmlab-bench"))
+        with redirect_stdout(io.StringIO()):
+            t = time.time()
+            txs = list(api.getAllTransactions(address))
+            t_history = time.time() - t
+            t = time.time()
+            api.getBalances(addresses)
+            t_balances = time.time() - t
+        assert len(txs) == history
+        print("%d in flight: history %.3fs, balances %.3fs" % (workers, t_history, t_balances))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
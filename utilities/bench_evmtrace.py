@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks building the annotated trace AST (evmtrace.traceEvmOutput without composing)
+on a synthetic geth trace, against the previous pipeline: evmResult, then buildAST and
+findReachings copying the simulated stack on every op.
+
+Usage:
+    python3 bench_evmtrace.py [steps] [stackdepth]
+"""
+import sys, os, time, json, random, tempfile, tracemalloc
+
+from evmlab import evmtrace
+from evmlab.evmtrace import opcodes, CallNode, PushNode, OpcodeNode, TransactionTrace, \
+    ReachingDefinitions, ReachesDefinitions
+
+PUSH1, POP, ADD, ISZERO, MSTORE, DUP1, SWAP1, JUMPDEST, CALL, STOP = \
+    0x60, 0x50, 0x01, 0x15, 0x52, 0x80, 0x90, 0x5b, 0xf1, 0x00
+
+
+def writeTrace(path, steps, stackdepth, seed = 1):
+    """ Writes a synthetic trace of `steps` ops (ending with a STOP), with the stack size
+    below `stackdepth`, and an occasional CALL into a short child frame """
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        def emit(pc, op, stack, depth):
+            f.write(json.dumps({"pc": pc, "op": op, "gas": "0x0", "gasCost": "0x3", "memory": "0x",
+                                "stack": ["0x%x" % v for v in stack], "depth": depth,
+                                "opName": opcodes[op][0]}, separators=(',', ':')))
+            f.write("\n")
+
+        stack = []
+        pc = 0
+        n = 0
+        while n < steps:
+            size = len(stack)
+            if size >= 7 and rnd.random() < 0.001:
+                emit(pc, CALL, stack, 1)
+                del stack[-7:]
+                # the called contract
+                for (ipc, op, before) in [(0, PUSH1, []), (2, PUSH1, [1]), (4, ADD, [1, 2]), (5, STOP, [3])]:
+                    emit(ipc, op, before, 2)
+                n = n + 5
+                stack.append(1)
+                pc = pc + 1
+                continue
+            if size < 2 or (size < stackdepth - 1 and rnd.random() < 0.45):
+                op = rnd.choice([PUSH1, PUSH1, DUP1]) if size > 0 else PUSH1
+            else:
+                op = rnd.choice([POP, ADD, ISZERO, MSTORE, SWAP1, JUMPDEST])
+            emit(pc, op, stack, 1)
+            if op == PUSH1:
+                stack.append(rnd.randrange(256))
+            elif op == DUP1:
+                stack.append(stack[-1])
+            elif op == SWAP1:
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif op == POP:
+                stack.pop()
+            elif op == ADD:
+                stack.append((stack.pop() + stack.pop()) & 0xffff)
+            elif op == ISZERO:
+                stack.append(int(stack.pop() == 0))
+            elif op == MSTORE:
+                del stack[-2:]
+            pc = pc + (2 if op == PUSH1 else 1)
+            n = n + 1
+        # the results of the last op are on the stack of the next one
+        emit(pc, STOP, stack, 1)
+        f.write(json.dumps({"output": "", "gasUsed": "0x0", "time": 1}) + "\n")
+
+
+def oldBuildAST(trace):
+    ops = []
+    stack = []
+    pc = 0
+    for step in trace:
+        pc = step.get('pc', pc)
+        opname, ins, outs, gas = evmtrace.opinfo(step['op'])
+        if ins > 0:
+            args = stack[-ins:][::-1]
+            stack = stack[:-ins]
+        else:
+            args = []
+        if 'ops' in step:
+            ops.append(CallNode(pc, step['depth'], step['op'], args, step['result'], oldBuildAST(step['ops'])))
+        elif opname.startswith('PUSH'):
+            ops.append(PushNode(pc, step['depth'], step['op'], args, step['result']))
+        else:
+            ops.append(OpcodeNode(pc, step['depth'], step['op'], args, step['result']))
+        pc += step.get('len', 1)
+        stack.extend(step['result'][::-1])
+    return ops
+
+def oldFindReachings(ast):
+    stack = []
+    for op in ast.ops:
+        if op.ins > 0:
+            args = stack[-op.ins:]
+            stack = stack[:-op.ins]
+        else:
+            args = []
+        if op.opname.startswith('DUP'):
+            stack.extend(args)
+            stack.append(args[0])
+        elif op.opname.startswith('SWAP'):
+            stack.append(args[-1])
+            stack.extend(args[1:-1])
+            stack.append(args[0])
+        else:
+            for arg in args:
+                arg.annotations[ReachesDefinitions].append(op)
+            op.setAnnotation(ReachingDefinitions(args[::-1]))
+            op.setAnnotation(ReachesDefinitions())
+            stack.extend([op] * op.outs)
+        if hasattr(op, 'ops'):
+            oldFindReachings(op)
+
+def oldTrace(path):
+    ast = TransactionTrace(oldBuildAST(evmtrace.evmResult(path)))
+    oldFindReachings(ast)
+    return ast
+
+def reachings(ast):
+    return [(depth, [a.pc for a in op.annotations[ReachingDefinitions]], len(op.annotations[ReachesDefinitions]))
+            for (depth, op) in ast.iterator() if ReachingDefinitions in op.annotations]
+
+def main(args):
+    steps = int(args[0]) if len(args) > 0 else 1000000
+    stackdepth = int(args[1]) if len(args) > 1 else 64
+    (fd, path) = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        t = time.time()
+        writeTrace(path, steps, stackdepth)
+        print("Trace: %d ops, stack up to %d, %d MB, written in %.1fs" % (
+            steps, stackdepth, os.path.getsize(path) >> 20, time.time() - t))
+
+        def run(name, fn):
+            t = time.time()
+            ast = fn()
+            print("%-38s %.1fs" % (name, time.time() - t))
+            return ast
+
+        old = run("evmResult + buildAST + findReachings:", lambda: oldTrace(path))
+        new = run("streamAST:", lambda: evmtrace.traceEvmOutput(path, compose = False))
+
+        # peak memory of building the AST
+        for (name, fn) in [("evmResult + buildAST + findReachings:", oldTrace),
+                           ("streamAST:", lambda p: evmtrace.traceEvmOutput(p, compose = False))]:
+            tracemalloc.start()
+            fn(path)
+            print("%-38s peak %d MB" % (name, tracemalloc.get_traced_memory()[1] >> 20))
+            tracemalloc.stop()
+
+        assert str(old) == str(new)
+        assert reachings(old) == reachings(new)
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks fetching the accounts and storage slots of a reproduction round against
+the stub JSON-RPC node in rpc_stub.py: one request per lookup (as the web3 backend does)
+versus the JSON-RPC batches of MultiApi with a BatchRpc backend.
+
+Usage:
+    python3 bench_rpc.py [accounts] [slots] [latency in ms]
+"""
+import sys, time
+from contextlib import redirect_stdout
+import io
+
+from evmlab import multiapi, rpc
+from evmlab.apicache import MemoryCache
+
+import rpc_stub
+
+
+def perCall(api, client, addresses, slots, blnum):
+    block = hex(blnum)
+    def account(address):
+        return (client.call("eth_getBalance", [address, block]),
+                client.call("eth_getCode", [address, block]),
+                client.call("eth_getTransactionCount", [address, block]))
+    def slot(address, key):
+        return client.call("eth_getStorageAt", [address, hex(key), block])
+    api._fetchAll(account, [(a,) for a in addresses])
+    api._fetchAll(slot, slots)
+
+def batched(api, client, addresses, slots, blnum):
+    api.getAccountInfos(addresses, blnum)
+    api.getStorageSlots(slots, blnum)
+
+def main(args):
+    naccounts = int(args[0]) if len(args) > 0 else 50
+    nslots = int(args[1]) if len(args) > 1 else 200
+    latency = float(args[2]) / 1000 if len(args) > 2 else 0.005
+    (server, url) = rpc_stub.serve(latency = latency)
+
+    addresses = ["0x%040x" % (0x1000 + i) for i in range(naccounts)]
+    slots = [(addresses[i % naccounts], i) for i in range(nslots)]
+    client = rpc.BatchRpc(url)
+
+    print("%d accounts, %d slots, %.1f ms latency per request" % (naccounts, nslots, latency * 1000))
+    for (name, fn) in [("one request per lookup", perCall), ("json-rpc batches", batched)]:
+        # a fresh in-memory cache each time, so that nothing is cached between runs
+        api = multiapi.MultiApi(rpc = client, cache = MemoryCache())
+        t = time.time()
+        with redirect_stdout(io.StringIO()):
+            fn(api, client, addresses, slots, 4000000)
+        print("%-24s %.3fs" % (name, time.time() - t))
+
+    client.close()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
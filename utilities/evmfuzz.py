@@ -21,33 +21,27 @@ def canon(str):
 def toText(op):
     return VMUtils.toText(op)
 
+# The clients are executed in long-lived containers, reused across executions
+gvm =  VMUtils.GethVM("holiman/std-gethvm", docker = True, poolsize = 1)
+pvm =  VMUtils.ParityVM("holiman/std-parityvm", docker = True, poolsize = 1)
+
 def execute(code, gas = 0xFFFF, verbose = False):
 
     from evmlab import vm
     from evmlab.genesis import Genesis
 
 
-    gvm =  VMUtils.GethVM("holiman/std-gethvm", docker = True)
-    pvm =  VMUtils.ParityVM("holiman/std-parityvm", docker = True)
-
     intrinsic_geth_gas = VMUtils.getIntrinsicGas(code)
     print("Intrinsic gas: %s" % str(intrinsic_geth_gas) )
     # sys.exit(0)
-    g_out = gvm.execute(code = code, gas = gas,json=True, genesis = Genesis().export_geth())
-    p_out = pvm.execute(code = code, gas = gas,json=True, genesis = Genesis().export_parity())
-
-    g_canon = VMUtils.GethVM.canonicalized(g_out)
-    p_canon = VMUtils.ParityVM.canonicalized(p_out)
-
-    g_txt = [toText(x) for x in g_canon]
-    p_txt = [toText(x) for x in p_canon]
-
-    import logging
-    logger = logging.getLogger()
+    # Both clients run concurrently, and are compared step by step while running.
+    # On the first difference, both are stopped
+    g_steps = gvm.executeStream(code = code, gas = gas,json=True, genesis = Genesis().export_geth())
+    p_steps = pvm.executeStream(code = code, gas = gas,json=True, genesis = Genesis().export_parity())
 
-    diff_found = vm.compare_traces([g_txt, p_txt],['Geth', 'Par'])
+    (equivalent, difftrace) = vm.compare_traces_stream([g_steps, p_steps],['Geth', 'Par'])
 
-    return (diff_found , [], gvm.lastCommand, pvm.lastCommand)
+    return (not equivalent , difftrace, gvm.lastCommand, pvm.lastCommand)
 
 #    def json_gen(o):
 #        for line in o:
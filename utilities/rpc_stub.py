@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Stub JSON-RPC node and etherchain API, for testing and benchmarking the api clients offline.
+
+It answers eth_getBalance, eth_getCode, eth_getTransactionCount and eth_getStorageAt
+(single calls and batches) with deterministic values derived from the parameters,
+optionally after a fixed delay per http request, to simulate the round trip to a remote node.
+
+The etherchain routes /api/account/<address> and /api/account/<address>/tx_asc/<offset>
+are served the same way; every address has a history of `history` transactions.
+
+Usage:
+    python3 rpc_stub.py [port] [latency in ms]
+"""
+import json, sys, threading, time, hashlib, re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _value(*params):
+    return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+
+def _balance(address, block):
+    return hex(int(_value(address, block)[:16], 16))
+
+def _code(address, block):
+    # Even-numbered addresses are contracts
+    if int(address, 16) % 2 == 0:
+        return "0x6001600101" + _value(address)[:64]
+    return "0x"
+
+def _nonce(address, block):
+    return hex(int(_value(address, block)[:2], 16))
+
+def _storage(address, key, block):
+    return "0x" + _value(address, key, block)
+
+
+METHODS = {
+    "eth_getBalance": _balance,
+    "eth_getCode": _code,
+    "eth_getTransactionCount": _nonce,
+    "eth_getStorageAt": _storage,
+}
+
+
+def _account(address):
+    return {"address": address,
+            "balance": int(_balance(address, "latest"), 16),
+            "nonce": int(_nonce(address, "latest"), 16),
+            "code": _code(address, "latest"),
+            "name": None, "storage": None}
+
+def _transaction(address, n):
+    other = "0x" + _value(address, n)[:40]
+    incoming = n % 2 == 0
+    return {"hash": "0x" + _value("tx", address, n),
+            "sender": other if incoming else address,
+            "recipient": address if incoming else other,
+            "amount": n, "gasUsed": 21000, "price": 20000000000,
+            "newContract": 0, "time": "2017-01-01T00:00:%02d.000Z" % (n % 60)}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # seconds to sleep before answering each http request
+    latency = 0
+    methods = METHODS
+    # number of transactions of each address on the etherchain api
+    history = 1000
+    pagesize = 50
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, call):
+        fn = self.methods.get(call.get("method"))
+        response = {"jsonrpc": "2.0", "id": call.get("id")}
+        if fn is None:
+            response["error"] = {"code": -32601, "message": "the method %s does not exist" % call.get("method")}
+        else:
+            response["result"] = fn(*call.get("params", []))
+        return response
+
+    def _send(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        m = re.match(r"^/api/account/(0x[0-9a-fA-F]+)(?:/tx_asc/(\d+))?$", self.path)
+        if m is None:
+            self._send(404, {"status": 404, "data": []})
+        elif m.group(2) is None:
+            self._send(200, {"status": 1, "data": [_account(m.group(1))]})
+        else:
+            offset = int(m.group(2))
+            txs = [_transaction(m.group(1), n) for n in range(offset, min(offset + self.pagesize, self.history))]
+            self._send(200, {"status": 1, "data": txs})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(request, list):
+            self._send(200, [self._answer(call) for call in request])
+        else:
+            self._send(200, self._answer(request))
+
+
+def serve(port = 0, latency = 0, history = 1000, handler = StubHandler):
+    """ Starts the stub server in a background thread, returns (server, url) """
+    handler = type("Handler", (handler,), {"latency": latency, "history": history})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return (server, "http://127.0.0.1:%d/" % server.server_address[1])
+
+
+def main(args):
+    port = int(args[0]) if len(args) > 0 else 8545
+    latency = float(args[1]) / 1000 if len(args) > 1 else 0
+    (server, url) = serve(port, latency)
+    print("Serving stub JSON-RPC on %s" % url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
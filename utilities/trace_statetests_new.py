@@ -5,6 +5,7 @@ Executes state tests on multiple clients, checking for EVM trace equivalence
 
 """
 import json, sys, re, os, subprocess, io, itertools, traceback, time, collections
+import argparse, multiprocessing, concurrent.futures
 from contextlib import redirect_stderr, redirect_stdout
 
 from evmlab import genesis as gen
@@ -26,6 +27,13 @@ logger.addHandler(ch)
 cfg ={}
 local_cfg = {}
 
+# When running with several workers, each worker has its own set of client
+# containers, named <client><suffix>
+CONTAINER_SUFFIX = ""
+
+def containerName(client_name):
+    return "%s%s" % (client_name, CONTAINER_SUFFIX)
+
 
 def parse_config():
     """Parses 'statetests.ini'-file, which 
@@ -340,13 +348,23 @@ def getStateTests(path = '/GeneralStateTests/', ignore = []):
                 yield os.path.join(subdir, f)
 
 def main():
+    parser = argparse.ArgumentParser(description="Executes state tests on multiple clients, checking for EVM trace equivalence")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of parallel workers, each with its own set of client containers (default 1)")
+    args = parser.parse_args()
+
     # Start all docker daemons that we'll use during the execution
-    startDaemons()
-    perform_tests(iterate_tests)
+    if args.workers > 1:
+        for i in range(args.workers):
+            startDaemons(suffix = workerSuffix(i), testeth = (i == 0))
+        perform_tests_parallel(iterate_tests, args.workers)
+    else:
+        startDaemons()
+        perform_tests(iterate_tests)
 
 
 def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
-    """ Ends the process, returns the canonical trace and also writes the 
+    """ Ends the process, returns the canonical trace (as a CompactTrace) and also writes the 
     full process output to a file, along with the command used to start the process"""
 
     outp = ""
@@ -363,8 +381,7 @@ def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
             f.write("# %s\n\n" % processInfo['cmd'])
             f.write("\n".join(outp))
 
-    canon_text = [VMUtils.toText(step) for step in canonicalizer(outp)]
-    return canon_text
+    return VMUtils.CompactTrace.fromSteps(canonicalizer(outp))
 
 def get_summary(combined_trace, n=20):
     """Returns (up to) n (default 20) preceding steps before the first diff, and the diff-section
@@ -411,7 +428,7 @@ def killDaemon(clientname):
 
  #   VMUtils.finishProc(VMUtils.startProc(["docker", "kill",clientname]))
 
-def startDaemons():
+def startDaemons(suffix = "", testeth = True):
     """ startDaemons starts docker processes for all clients. The actual execution of 
     testcases is then performed via docker exec. Means that executing a specific testcase
     does not require starting a whole new docker context, instead we just reuse the existing
@@ -422,11 +439,15 @@ def startDaemons():
     docker run ethereum/client-go:alltools-latest sleep 356d    
     ```
 
+    The `suffix` is appended to the container names, so that several workers
+    can each have their own set of containers.
     """
     # Start testeth
     daemons = []
     (name, isDocker) = getBaseCmd("testeth")
-    if isDocker:
+    if not testeth:
+        pass
+    elif isDocker:
         # First, kill off any existing daemons
         logger.info("Starting daemons for testeth")
         killDaemon("testeth")
@@ -445,9 +466,9 @@ def startDaemons():
         (name, isDocker) = getBaseCmd(client_name)
         if isDocker:
             # First, kill off any existing daemons
-            killDaemon(client_name)
-            procinfo = startDaemon(client_name, name)
-            daemons.append( (procinfo, client_name ))        
+            killDaemon(client_name + suffix)
+            procinfo = startDaemon(client_name + suffix, name)
+            daemons.append( (procinfo, client_name + suffix ))        
         else:
             logger.warning("Not a docker client %s", client_name)
 
@@ -523,12 +544,12 @@ def startGeth(test):
 
     """
     cmd = ["evm","--json","--nomemory","statetest","/testfiles/%s" % os.path.basename(test.tmpfile)]
-    return execInDocker("geth", cmd, stdout = False)
+    return execInDocker(containerName("geth"), cmd, stdout = False)
     
 
 def startParity(test):
     cmd = ["/parity-evm","state-test", "--std-json","/testfiles/%s" % os.path.basename(test.tmpfile)]
-    return execInDocker("parity", cmd)
+    return execInDocker(containerName("parity"), cmd)
 
 def startHera(test):
     cmd = [ "/build/test/testeth", 
@@ -537,7 +558,7 @@ def startHera(test):
             "--evmc", "evm2wasm.js=true", "--evmc", "fallback=false",
             "--singletest", "/testfiles/%s" % os.path.basename(test.tmpfile), test.name,
             ]
-    return execInDocker("hera", cmd, stderr=False)
+    return execInDocker(containerName("hera"), cmd, stderr=False)
 
 def startCpp(test):
     
@@ -549,7 +570,7 @@ def startCpp(test):
             "--singletest", "/testfiles/%s" % os.path.basename(test.tmpfile), test.name,
             "--jsontrace", "'%s'" % json.dumps({"disableStorage": True, "disableMemory": True, "disableStack": False, "fullStorage": False}) 
             ]
-    return execInDocker("cpp", cmd, stderr=False)
+    return execInDocker(containerName("cpp"), cmd, stderr=False)
 
 #def startPython(test):
 #
@@ -563,7 +584,9 @@ def startCpp(test):
 #    return {'proc':VMUtils.startProc(cmd), 'cmd': " ".join(cmd), 'output' : 'stdout'}
 #
 
-def start_processes(test):
+def start_processes(test, executor = None):
+    """ Executes the test on all clients. If an executor is given, the
+    clients are executed concurrently """
     clients = cfg['DO_CLIENTS']
 
     starters = {'geth': startGeth, 'cpp': startCpp, 'parity': startParity, 'hera': startHera}
@@ -572,18 +595,24 @@ def start_processes(test):
     #Start the processes
     for client_name in clients:
         if client_name in starters.keys():
-            procinfo = starters[client_name](test)
+            if executor is not None:
+                procinfo = executor.submit(starters[client_name], test)
+            else:
+                procinfo = starters[client_name](test)
             test.procs.append( (procinfo, client_name ))        
         else:
             logger.warning("Undefined client %s", client_name)
 
+    if executor is not None:
+        test.procs = [(future.result(), client_name) for (future, client_name) in test.procs]
+
 
 canonicalizers = {
-    "geth" : VMUtils.GethVM.canonicalized, 
-    "cpp"  : VMUtils.CppVM.canonicalized, 
-    "py"   : VMUtils.PyVM.canonicalized, 
-    "parity"  :  VMUtils.ParityVM.canonicalized ,
-    "hera" : VMUtils.HeraVM.canonicalized,
+    "geth" : VMUtils.GethVM.canonicalizedStream, 
+    "cpp"  : VMUtils.CppVM.canonicalizedStream, 
+    "py"   : VMUtils.PyVM.canonicalizedStream, 
+    "parity"  :  VMUtils.ParityVM.canonicalizedStream ,
+    "hera" : VMUtils.HeraVM.canonicalizedStream,
 }
 
 def end_processes(test):
@@ -605,8 +634,9 @@ def processTraces(test):
     if test is None:
         return True
 
-    # Process previous traces
-    (equivalent, trace_output) = VMUtils.compare_traces(test.canon_traces, cfg['DO_CLIENTS']) 
+    # Process previous traces. Only the fingerprints are compared, the (full) combined
+    # trace is only rendered if they differ
+    (equivalent, trace_output) = VMUtils.compare_compact_traces(test.canon_traces, cfg['DO_CLIENTS'], before = None, after = None) 
 
     if equivalent:
         tmpfile_path = os.path.abspath(test.tmpfile)
@@ -690,6 +720,76 @@ def perform_tests(test_iterator):
 
     return (n, len(failures), pass_count, failures)
 
+def workerSuffix(i):
+    return "-w%d" % i
+
+# Thread pool used by a worker to execute all clients of a test concurrently
+client_executor = None
+
+def init_worker(worker_ids):
+    """ Initializes a worker process of the pool, which uses its own set of containers """
+    global dockerclient, client_executor, CONTAINER_SUFFIX
+    # The docker client (and its connection pool) can't be shared with the parent
+    dockerclient = docker.from_env()
+    client_executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(cfg['DO_CLIENTS']))
+    CONTAINER_SUFFIX = workerSuffix(worker_ids.get())
+
+def run_test(test):
+    """ Executes one test on all clients, within a worker.
+    Returns (test id, equivalent) """
+    test.writeToFile()
+    start_processes(test, client_executor)
+    end_processes(test)
+    return (test.id(), processTraces(test))
+
+def perform_tests_parallel(test_iterator, workers):
+    """ Shards the tests across a pool of worker processes. Each worker executes
+    the clients of a test concurrently, in its own set of containers. """
+
+    pass_count = 0
+    fail_count = 0
+    failures = []
+    n = 0
+
+    start_time = time.time()
+
+    worker_ids = multiprocessing.Queue()
+    for i in range(workers):
+        worker_ids.put(i)
+
+    def __record(result):
+        nonlocal fail_count, pass_count
+        (test_id, equivalent) = result
+        if equivalent:
+            pass_count = pass_count +1
+        else:
+            fail_count = fail_count +1
+            failures.append(test_id)
+
+        if (fail_count + pass_count) % 10 == 0:
+            time_elapsed = time.time() - start_time
+            logger.info("Fails: {}, Pass: {}, #test {} speed: {:f} tests/s".format(
+                    fail_count, 
+                    pass_count, 
+                    (fail_count + pass_count),
+                    (fail_count + pass_count) / time_elapsed
+                ))
+
+    # Keep a bounded number of tests in flight, the test iterator may be endless
+    in_flight = collections.deque()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(worker_ids,)) as pool:
+        for test in test_iterator():
+            n = n+1
+            logger.info("Test id: %s" % test.id())
+            in_flight.append(pool.apply_async(run_test, (test,)))
+            while len(in_flight) >= 2 * workers or (in_flight and in_flight[0].ready()):
+                __record(in_flight.popleft().get())
+
+        while in_flight:
+            __record(in_flight.popleft().get())
+
+    return (n, len(failures), pass_count, failures)
+
 """
 ## need to get redirect_stdout working for the python-afl fuzzer
 